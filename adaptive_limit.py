@@ -0,0 +1,50 @@
+import logging
+import threading
+import time
+
+class AdaptiveLimit:
+    """AIMD concurrency limit: grows by about one slot per window of fast responses,
+    shrinks multiplicatively on slow responses and halves (pausing for Retry-After) on overload"""
+
+    def __init__(self, name, max_limit, initial_limit=1, target_latency=1.0, backoff=0.9):
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = float(min(initial_limit, max_limit))
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, stop_event=None):
+        """Block until a slot is free and no Retry-After pause is active; False if stop_event is set during a pause.
+        A full limit is always waited out, since in-flight requests release their slots within the request timeout"""
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return True
+                if wait > 0 and stop_event is not None and stop_event.is_set():
+                    return False
+                self.condition.wait(timeout=wait if wait > 0 else 1)
+
+    def release(self, latency, overloaded=False, retry_after=None):
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit / 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                self.logger.warning(f"API {self.name} signalled overload, concurrency limit now {int(self.limit)}"
+                                    f"{f', pausing {retry_after:.0f}s' if retry_after else ''}")
+            elif latency is not None and latency > self.target_latency:
+                self.limit = max(1.0, self.limit * self.backoff)
+            elif latency is not None:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
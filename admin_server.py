@@ -0,0 +1,158 @@
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+class BodyTooLarge(Exception):
+    pass
+
+class AdminServer:
+    def __init__(self, config):
+        self.logger = logging.getLogger(__name__)
+        self.host = config.get('host', '127.0.0.1')
+        self.port = config.get('port', 8025)
+        self.token = config.get('token')
+        self.max_body_bytes = config.get('max_body_bytes', 64 * 1024 * 1024)
+        self.routes = {}  # { (method, path): func(request, query) -> (status, body[, content_type]) }
+        self.server = None
+
+    def add_route(self, method, path, func):
+        self.routes[(method.upper(), path)] = func
+
+    def start(self):
+        self.logger.debug(f"Starting admin server on {self.host}:{self.port}")
+        admin = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                admin.handle_request(self, 'GET')
+
+            def do_POST(self):
+                admin.handle_request(self, 'POST')
+
+            def log_message(self, format, *args):
+                admin.logger.debug(f"{self.address_string()} {format % args}")
+
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), RequestHandler)
+        except OSError as e:
+            self.logger.error(f"Failed to start admin server on {self.host}:{self.port}: {e}")
+            return False
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True, name="Admin-Server")
+        thread.start()
+        self.logger.info(f"Admin server listening on {self.host}:{self.port}")
+        return True
+
+    def handle_request(self, request, method):
+        url = urlsplit(request.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        authorization = request.headers.get('Authorization', '').encode('utf-8')
+        if self.token and not hmac.compare_digest(authorization, f"Bearer {self.token}".encode('utf-8')):
+            self.send_response(request, 401, {'error': 'unauthorized'})
+            return
+        func = self.routes.get((method, url.path))
+        if func is None:
+            self.send_response(request, 404, {'error': f"no route for {method} {url.path}"})
+            return
+        try:
+            length = request.headers.get('Content-Length')
+            if method == 'POST' and length is None and not self.is_chunked(request):
+                self.send_response(request, 411, {'error': 'Content-Length or chunked Transfer-Encoding required'})
+                return
+            if length is not None and int(length) > self.max_body_bytes:
+                self.send_response(request, 413, {'error': 'request body too large'})
+                return
+            response = func(request, query)
+        except BodyTooLarge:
+            self.send_response(request, 413, {'error': 'request body too large'})
+            return
+        except (ValueError, KeyError) as e:
+            self.send_response(request, 400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.logger.error(f"Admin request {method} {url.path} failed: {e}")
+            self.send_response(request, 500, {'error': 'internal error'})
+            return
+        try:
+            self.send_response(request, *response)
+        except Exception as e:
+            self.logger.error(f"Admin response for {method} {url.path} failed: {e}")
+
+    def send_response(self, request, status, body, content_type='application/json'):
+        """Send a JSON body, or stream an iterable of text chunks without buffering it"""
+        if isinstance(body, (dict, list)):
+            data = json.dumps(body).encode('utf-8')
+            request.send_response(status)
+            request.send_header('Content-Type', content_type)
+            request.send_header('Content-Length', str(len(data)))
+            request.end_headers()
+            request.wfile.write(data)
+            return
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.end_headers()
+        for chunk in body:
+            request.wfile.write(chunk.encode('utf-8'))
+
+    def is_chunked(self, request):
+        return 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+
+    def iter_chunks(self, request):
+        """Yield the data of a chunked request body, enforcing max_body_bytes"""
+        total = 0
+        while True:
+            size_line = request.rfile.readline(1024)
+            if not size_line:
+                raise ValueError("truncated chunked body")
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                while request.rfile.readline(1024).strip():
+                    pass  # Skip trailers
+                return
+            total += size
+            if total > self.max_body_bytes:
+                raise BodyTooLarge()
+            data = request.rfile.read(size)
+            if len(data) < size:
+                raise ValueError("truncated chunked body")
+            request.rfile.readline(1024)  # CRLF after the chunk data
+            yield data
+
+    def read_body(self, request):
+        if self.is_chunked(request):
+            return b''.join(self.iter_chunks(request))
+        return request.rfile.read(int(request.headers.get('Content-Length', 0)))
+
+    def iter_lines(self, request):
+        """Yield the non-empty lines of a request body (Content-Length or chunked), reading it incrementally"""
+        if self.is_chunked(request):
+            buffer = b''
+            for data in self.iter_chunks(request):
+                lines = (buffer + data).split(b'\n')
+                buffer = lines.pop()
+                for line in lines:
+                    line = line.strip()
+                    if line:
+                        yield line
+            if buffer.strip():
+                yield buffer.strip()
+            return
+        remaining = int(request.headers.get('Content-Length', 0))
+        while remaining > 0:
+            line = request.rfile.readline(remaining)
+            if not line:
+                break
+            remaining -= len(line)
+            line = line.strip()
+            if line:
+                yield line
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.logger.debug("Closed admin server")
+            self.server = None
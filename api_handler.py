@@ -2,7 +2,12 @@ import threading
 import queue
 import logging
 import time
+import heapq
+import itertools
+from email.utils import parsedate_to_datetime
 import requests
+from adaptive_limit import AdaptiveLimit
+from api_template import CompiledTemplate, CompiledJson, TEMPLATE_FIELDS
 
 class ApiHandler:
     def __init__(self, config, retry_settings):
@@ -14,87 +19,257 @@ class ApiHandler:
         self.headers_template = config.get('headers', {})
         self.payload_template = config.get('payload', {})
         self.timeout = config.get('timeout', 10)
+        self.endpoint_template = CompiledTemplate(self.endpoint)
+        self.compiled_headers = {
+            k: CompiledTemplate(v) if isinstance(v, str) else v
+            for k, v in self.headers_template.items()
+        }
+        if 'User-Agent' not in self.compiled_headers:
+            self.compiled_headers['User-Agent'] = f"SMS-Gateway/{self.name}"
+        if self.method == "GET":
+            self.compiled_params = {
+                k: CompiledTemplate(v) if isinstance(v, str) else v
+                for k, v in self.payload_template.items()
+            }
+        else:
+            self.compiled_payload = CompiledJson(self.payload_template)
+            if not any(k.lower() == 'content-type' for k in self.compiled_headers):
+                self.compiled_headers['Content-Type'] = 'application/json'
         self.api_queue = queue.Queue()
         self.max_retries = retry_settings.get('max_retries', 3)
         self.initial_delay = retry_settings.get('initial_delay', 10)
+        self.max_throttle_retries = config.get('max_throttle_retries', 20)
+        self.max_concurrency = max(1, config.get('max_concurrency', 8))
+        self.limit = AdaptiveLimit(
+            self.name,
+            self.max_concurrency,
+            initial_limit=config.get('initial_concurrency', 1),
+            target_latency=config.get('target_latency', 2.0)
+        )
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stop_event = threading.Event()
+        self.pending = []  # Messages set aside during shutdown
+        self.in_flight = {}  # { worker thread ident: message it is handling }
+        self.workers_lock = threading.Lock()
+        self.active_workers = 0
+        self.delayed = []  # Heap of (due, seq, message) waiting out a retry backoff
+        self.delayed_seq = itertools.count()
+        self.delayed_condition = threading.Condition()
 
     def start(self):
-        self.logger.debug(f"Starting API handler for {self.name}")
-        thread = threading.Thread(
-            target=self.process_api_queue,
-            daemon=True,
-            name=f"API-{self.name}"
-        )
-        thread.start()
+        self.logger.debug(f"Starting API handler for {self.name} with up to {self.max_concurrency} workers")
+        self.active_workers = self.max_concurrency
+        for i in range(self.max_concurrency):
+            thread = threading.Thread(
+                target=self.process_api_queue,
+                daemon=True,
+                name=f"API-{self.name}-{i}"
+            )
+            thread.start()
+        threading.Thread(target=self.process_delayed, daemon=True, name=f"API-{self.name}-retry").start()
         return True
 
+    def process_delayed(self):
+        """Put messages back on the queue once their retry backoff has passed, so workers never sleep on a retry"""
+        with self.delayed_condition:
+            while self.active_workers and not self.stop_event.is_set():
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self.api_queue.put(heapq.heappop(self.delayed)[2])
+                self.delayed_condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
     def process_api_queue(self):
         self.logger.debug(f"Starting API processor for {self.name}")
+        ident = threading.get_ident()
         while True:
+            self.in_flight.pop(ident, None)
             message = self.api_queue.get()
+            if message is None:
+                self.api_queue.task_done()
+                if not self.api_queue.empty():
+                    self.api_queue.put(None)  # Let retried messages drain first
+                    continue
+                with self.workers_lock:
+                    self.active_workers -= 1
+                    last = self.active_workers == 0
+                if not last:
+                    self.api_queue.put(None)  # Pass the sentinel on to the next worker
+                    break
+                self.close()
+                break
+            self.in_flight[ident] = message
             self.logger.debug(f"Processing API request on {self.name}: {message}, queue size: {self.api_queue.qsize()}")
             retry_count = message.get('retry_count', 0)
 
-            if not self.send_api_request(message, retry_count):
+            # Wait for a concurrency slot; only as many requests run as the endpoint currently tolerates
+            if not self.limit.acquire(self.stop_event):
+                self.pending.append(message)
+                self.api_queue.task_done()
+                continue
+            started = time.monotonic()
+            result, retry_after = self.send_api_request(message)
+            latency = time.monotonic() - started
+            self.limit.release(
+                latency if result in ('sent', 'timeout') else None,
+                overloaded=result == 'overloaded',
+                retry_after=(retry_after or self.initial_delay) if result == 'overloaded' else None
+            )
+
+            if result == 'overloaded':
+                self.requeue_throttled(message)
+            elif result != 'sent':
                 self.retry_message(message, retry_count)
             self.api_queue.task_done()
 
-    def send_api_request(self, message, retry_count):
+    def send_api_request(self, message):
+        """Send one request; returns (result, retry_after) with result 'sent', 'overloaded', 'timeout' or 'failed'"""
         try:
-            sender = message.get('sender', '')
-            timestamp = message.get('timestamp', '')
-            text = message.get('text', '')
+            values = {field: message.get(field, '') for field in TEMPLATE_FIELDS}
+            values['message'] = message.get('text', '')
 
-            endpoint = self.endpoint.format(sender=sender, timestamp=timestamp, message=text)
+            endpoint = self.endpoint_template.render(values)
             headers = {
-                k: v.format(sender=sender, timestamp=timestamp, message=text) if isinstance(v, str) else v
-                for k, v in self.headers_template.items()
-            }
-            if 'User-Agent' not in headers:
-                headers['User-Agent'] = f"SMS-Gateway/{self.name}"
-            payload = {
-                k: v.format(sender=sender, timestamp=timestamp, message=text) if isinstance(v, str) else v
-                for k, v in self.payload_template.items()
+                k: v.render(values) if isinstance(v, CompiledTemplate) else v
+                for k, v in self.compiled_headers.items()
             }
+            if self.method == "GET":
+                payload = {
+                    k: v.render(values) if isinstance(v, CompiledTemplate) else v
+                    for k, v in self.compiled_params.items()
+                }
+            else:
+                payload = self.compiled_payload.render(values)
 
             self.logger.debug(f"Sending {self.method} request to {endpoint} with headers: {headers}, payload: {payload}")
 
             if self.method == "POST":
-                response = requests.post(endpoint, headers=headers, json=payload, timeout=self.timeout)
+                response = self.session.post(endpoint, headers=headers, data=payload.encode('utf-8'), timeout=self.timeout)
             elif self.method == "GET":
-                response = requests.get(endpoint, headers=headers, params=payload if payload else None, timeout=self.timeout)
+                response = self.session.get(endpoint, headers=headers, params=payload if payload else None, timeout=self.timeout)
             elif self.method == "PUT":
-                response = requests.put(endpoint, headers=headers, json=payload, timeout=self.timeout)
+                response = self.session.put(endpoint, headers=headers, data=payload.encode('utf-8'), timeout=self.timeout)
             else:
                 raise ValueError(f"Unsupported method: {self.method}")
 
+            if response.status_code in (429, 503):
+                retry_after = self.parse_retry_after(response.headers.get('Retry-After'))
+                self.logger.warning(f"API {self.name} is throttling ({response.status_code}), retry after {retry_after}")
+                return 'overloaded', retry_after
             response.raise_for_status()
             self.logger.info(f"Sent API request from {self.name} to {endpoint}: {response.status_code}")
-            return True
+            return 'sent', None
+        except requests.exceptions.Timeout as e:
+            self.logger.error(f"Timeout sending API request from {self.name}: {e}")
+            return 'timeout', None
         except requests.exceptions.RequestException as e:
             error_msg = f"Error sending API request from {self.name}: {e}"
             if hasattr(e, 'response') and e.response is not None:
                 error_msg += f", Status: {e.response.status_code}, Response: {e.response.text}"
             self.logger.error(error_msg)
-            return False
+            return 'failed', None
+
+    def parse_retry_after(self, value):
+        """Retry-After as seconds (delta-seconds or HTTP date), capped at an hour; None if absent or invalid"""
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0.0), 3600.0)
+
+    def requeue_throttled(self, message):
+        """Put a throttled message straight back; the limiter holds dispatch until Retry-After expires"""
+        if self.stop_event.is_set():
+            self.pending.append(message)
+            return
+        throttle_count = message.get('throttle_count', 0)
+        if throttle_count < self.max_throttle_retries:
+            message['throttle_count'] = throttle_count + 1
+            self.api_queue.put(message)
+        else:
+            self.logger.error(f"Max throttle retries ({self.max_throttle_retries}) reached for API request to {self.name}")
 
     def retry_message(self, message, retry_count):
+        if self.stop_event.is_set():
+            self.pending.append(message)
+            return
         if retry_count < self.max_retries:
             delay = self.initial_delay * (2 ** retry_count)
             self.logger.info(f"Retrying API request to {self.name} (attempt {retry_count + 1}/{self.max_retries}) after {delay}s")
             message['retry_count'] = retry_count + 1
-            time.sleep(delay)
-            self.api_queue.put(message)
+            with self.delayed_condition:
+                if self.stop_event.is_set():
+                    self.pending.append(message)
+                    return
+                heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.delayed_seq), message))
+                self.delayed_condition.notify()
         else:
             self.logger.error(f"Max retries ({self.max_retries}) reached for API request to {self.name}")
 
-    def send_api(self, sender, timestamp, text):
+    def send_api(self, sender, timestamp, text, modem='', multipart_ref='', multipart_part='', multipart_total=''):
         self.api_queue.put({
             'sender': sender,
             'timestamp': timestamp,
             'text': text,
+            'modem': modem,
+            'multipart_ref': multipart_ref,
+            'multipart_part': multipart_part,
+            'multipart_total': multipart_total,
             'retry_count': 0
         })
 
+    def begin_shutdown(self):
+        """Stop retrying: failed messages are kept in pending instead of being backed off"""
+        self.stop_event.set()
+        self.limit.wake()
+        with self.delayed_condition:
+            self.delayed_condition.notify_all()
+
+    def is_idle(self):
+        return self.api_queue.unfinished_tasks == 0
+
+    def take_pending(self):
+        """Remove and return every queued, backed-off or set-aside message; a stop sentinel stays queued"""
+        with self.delayed_condition:
+            messages = self.pending + [message for _, _, message in sorted(self.delayed)]
+            self.pending = []
+            self.delayed = []
+        stopping = False
+        while True:
+            try:
+                message = self.api_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.api_queue.task_done()
+            if message is None:
+                stopping = True
+            else:
+                messages.append(message)
+        if stopping:
+            self.api_queue.put(None)  # Workers still need it to exit
+        return messages
+
+    def take_in_flight(self):
+        """Return the messages workers are handling right now (they stay with the workers)"""
+        return list(self.in_flight.values())
+
+    def restore_pending(self, messages):
+        for message in messages:
+            self.api_queue.put(message)
+
+    def stop(self):
+        """Stop the worker threads once queued messages are handled"""
+        self.api_queue.put(None)
+
     def close(self):
+        with self.delayed_condition:
+            self.delayed_condition.notify_all()  # Lets process_delayed see the workers are gone
+        self.session.close()
         self.logger.debug(f"Closed API handler {self.name}")
\ No newline at end of file
@@ -0,0 +1,78 @@
+import json
+import logging
+from string import Formatter
+
+TEMPLATE_FIELDS = ('sender', 'timestamp', 'message', 'modem', 'multipart_ref', 'multipart_part', 'multipart_total')
+
+class CompiledTemplate:
+    """A str.format-style template parsed once into literal and field pieces"""
+
+    def __init__(self, template):
+        self.logger = logging.getLogger(__name__)
+        self.template = template
+        self.parts = []  # [(literal_text, field_name, conversion, format_spec), ...]
+        for literal, field_name, format_spec, conversion in Formatter().parse(template):
+            if field_name is not None and field_name not in TEMPLATE_FIELDS:
+                self.logger.warning(f"Unknown template field {{{field_name}}} in '{template}', rendering it empty")
+            self.parts.append((literal, field_name, conversion, format_spec or ''))
+        self.constant = all(field_name is None for _, field_name, _, _ in self.parts)
+        if self.constant:
+            self.template = ''.join(literal for literal, _, _, _ in self.parts)
+
+    def render(self, values):
+        if self.constant:
+            return self.template
+        pieces = []
+        for literal, field_name, conversion, format_spec in self.parts:
+            pieces.append(literal)
+            if field_name is None:
+                continue
+            value = values.get(field_name, '')
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            elif conversion == 's':
+                value = str(value)
+            pieces.append(format(value, format_spec))
+        return ''.join(pieces)
+
+class CompiledJson:
+    """A JSON payload template whose constant parts are serialized once; only string fields are encoded per message"""
+
+    def __init__(self, payload):
+        self.fragments = []  # constant JSON text or CompiledTemplate to be rendered and encoded
+        self.compile(payload)
+        merged = []
+        for fragment in self.fragments:
+            if isinstance(fragment, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += fragment
+            else:
+                merged.append(fragment)
+        self.fragments = merged
+
+    def compile(self, value):
+        if isinstance(value, str):
+            template = CompiledTemplate(value)
+            self.fragments.append(json.dumps(template.template) if template.constant else template)
+        elif isinstance(value, dict):
+            self.fragments.append('{')
+            for i, (key, item) in enumerate(value.items()):
+                self.fragments.append(f"{', ' if i else ''}{json.dumps(str(key))}: ")
+                self.compile(item)
+            self.fragments.append('}')
+        elif isinstance(value, (list, tuple)):
+            self.fragments.append('[')
+            for i, item in enumerate(value):
+                if i:
+                    self.fragments.append(', ')
+                self.compile(item)
+            self.fragments.append(']')
+        else:
+            self.fragments.append(json.dumps(value))
+
+    def render(self, values):
+        return ''.join(
+            fragment if isinstance(fragment, str) else json.dumps(fragment.render(values))
+            for fragment in self.fragments
+        )
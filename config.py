@@ -8,6 +8,7 @@ class ConfigManager:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         self.config = self.load_config()
+        self.config_mtime = self.get_config_mtime()
 
     def load_config(self):
         self.logger.debug("Loading configuration")
@@ -20,7 +21,8 @@ class ConfigManager:
                 "retry_settings": {"max_retries": 3, "initial_delay": 10},
                 "rules": [{"name": "test1", "sender": ["+96895021117"]}],
                 "sms_retention_days": 7,  # Retention period for SMS messages
-                "multipart_timeout_minutes": 5  # Timeout for multipart SMS parts
+                "multipart_timeout_minutes": 5,  # Timeout for multipart SMS parts
+                "config_reload_interval": 10  # Seconds between config file checks, 0 disables
             }
             with open(CONFIG_FILE, 'w') as f:
                 json.dump(default_config, f, indent=4)
@@ -35,6 +37,35 @@ class ConfigManager:
             self.logger.debug(f"Loaded multipart timeout: {config.get('multipart_timeout_minutes', 2)} minutes")
             return config
 
+    def get_config_mtime(self):
+        try:
+            return os.path.getmtime(CONFIG_FILE)
+        except OSError:
+            return None
+
+    def config_changed(self):
+        """Check whether the config file was modified since it was last loaded"""
+        return self.get_config_mtime() != self.config_mtime
+
+    def reload_config(self):
+        """Reload the config file, keeping the current config if the new one is invalid"""
+        mtime = self.get_config_mtime()
+        if mtime is None:
+            # load_config would write a default config in its place
+            self.logger.error(f"Config file {CONFIG_FILE} is missing, keeping current config")
+            self.config_mtime = mtime
+            return False
+        try:
+            config = self.load_config()
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.error(f"Failed to reload configuration, keeping current config: {e}")
+            self.config_mtime = mtime
+            return False
+        self.config = config
+        self.config_mtime = mtime
+        self.logger.info("Configuration reloaded")
+        return True
+
     def get_modem_configs(self):
         return self.config['modems']
 
@@ -51,4 +82,40 @@ class ConfigManager:
         return self.config.get('sms_retention_days', 7)
 
     def get_multipart_timeout_minutes(self):
-        return self.config.get('multipart_timeout_minutes', 5)
\ No newline at end of file
+        return self.config.get('multipart_timeout_minutes', 5)
+
+    def get_api_configs(self):
+        return self.config.get('api_providers', [])
+
+    def get_dedup_ttl_seconds(self):
+        return self.config.get('dedup_ttl_seconds', 3600)
+
+    def get_dedup_max_entries(self):
+        return self.config.get('dedup_max_entries', 10000)
+
+    def get_rate_limits(self):
+        return self.config.get('rate_limits', {})
+
+    def get_delivery_report_ttl(self):
+        return self.config.get('delivery_report_ttl', 86400)
+
+    def get_modem_startup_timeout(self):
+        return self.config.get('modem_startup_timeout', 30)
+
+    def get_admin_server_config(self):
+        return self.config.get('admin_server', {"enabled": False})
+
+    def get_shutdown_timeout(self):
+        return self.config.get('shutdown_timeout', 30)
+
+    def get_spool_file(self):
+        return self.config.get('spool_file', 'pending_messages.json')
+
+    def get_profiling_config(self):
+        return self.config.get('profiling', {})
+
+    def get_scale_out_config(self):
+        return self.config.get('scale_out', {"enabled": False})
+
+    def get_config_reload_interval(self):
+        return self.config.get('config_reload_interval', 10)
\ No newline at end of file
@@ -1,5 +1,12 @@
 import sqlite3
 import logging
+from datetime import datetime, timezone
+
+def to_utc(value):
+    """Normalise a datetime or ISO 8601 string to an aware UTC datetime; naive values are taken as local time"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.astimezone(timezone.utc)
 
 class DatabaseManager:
     def __init__(self, db_file='sms_database.db'):
@@ -23,4 +30,30 @@ class DatabaseManager:
         with sqlite3.connect(self.db_file) as conn:
             conn.execute('INSERT INTO messages (modem_name, sender, timestamp, message) VALUES (?, ?, ?, ?)',
                         (modem_name, sms.number, sms.time.isoformat(), sms.text))
-        self.logger.info(f"Saved SMS from {sms.number} to database from {modem_name}")
\ No newline at end of file
+        self.logger.info(f"Saved SMS from {sms.number} to database from {modem_name}")
+
+    def iter_sms(self, since=None, until=None, sender=None, chunk_size=500):
+        """Yield matching messages as dicts, one keyset-paginated query per chunk. since and until are datetimes
+        or ISO strings; stored timestamps carry the SMSC's UTC offset, so both sides are compared in UTC"""
+        since = to_utc(since) if since is not None else None
+        until = to_utc(until) if until is not None else None
+        conditions = ['id > ?']
+        params = []
+        if sender is not None:
+            conditions.append('sender = ?')
+            params.append(sender)
+        query = (f"SELECT id, modem_name, sender, timestamp, message FROM messages "
+                 f"WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?")
+        last_id = 0
+        while True:
+            with sqlite3.connect(self.db_file) as conn:
+                rows = conn.execute(query, [last_id] + params + [chunk_size]).fetchall()
+            if not rows:
+                return
+            for row_id, modem_name, number, timestamp, text in rows:
+                if since is not None or until is not None:
+                    moment = to_utc(timestamp)
+                    if (since is not None and moment < since) or (until is not None and moment > until):
+                        continue
+                yield {'modem': modem_name, 'sender': number, 'timestamp': timestamp, 'text': text}
+            last_id = rows[-1][0]
\ No newline at end of file
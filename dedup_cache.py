@@ -0,0 +1,37 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+class DedupCache:
+    def __init__(self, ttl_seconds, max_entries):
+        self.logger = logging.getLogger(__name__)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # { digest: expiry_time }, oldest first
+        self.lock = threading.Lock()
+        self.logger.debug(f"Initialized dedup cache with TTL {ttl_seconds}s and {max_entries} max entries")
+
+    def make_key(self, sms):
+        """Hash sender, text and SMSC timestamp into a fixed-size key"""
+        timestamp = sms.time.isoformat() if hasattr(sms.time, 'isoformat') else str(sms.time)
+        data = f"{sms.number}\x00{timestamp}\x00{sms.text}".encode('utf-8', errors='replace')
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def check_and_add(self, sms):
+        """Return True if the message was already seen within the TTL, otherwise remember it"""
+        key = self.make_key(sms)
+        now = time.monotonic()
+        with self.lock:
+            # Entries share one TTL, so insertion order is also expiry order
+            while self.entries:
+                oldest_key, expiry = next(iter(self.entries.items()))
+                if expiry > now and len(self.entries) < self.max_entries:
+                    break
+                del self.entries[oldest_key]
+            expiry = self.entries.get(key)
+            if expiry is not None:
+                return True
+            self.entries[key] = now + self.ttl_seconds
+            return False
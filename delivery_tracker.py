@@ -0,0 +1,118 @@
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+LATENCY_BUCKETS = (5, 10, 30, 60, 120, 300, 600, 1800, 3600, 21600)  # Upper bounds in seconds; last bucket is +Inf
+
+class DeliveryTracker:
+    def __init__(self, ttl_seconds=86400, max_entries=100000):
+        self.logger = logging.getLogger(__name__)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.pending = OrderedDict()  # { (modem_name, reference): record }, oldest first
+        self.stats = defaultdict(lambda: {
+            'sent': 0, 'delivered': 0, 'failed': 0, 'expired': 0,
+            'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'latency_sum': 0.0
+        })
+        self.lock = threading.Lock()
+        self.start_cleanup_thread()
+        self.logger.debug(f"Initialized delivery tracker with TTL {ttl_seconds}s")
+
+    def start_cleanup_thread(self):
+        """Start a thread to expire sends that never got a status report"""
+        def cleanup_task():
+            while True:
+                time.sleep(60)  # Check every minute
+                self.expire_pending()
+        thread = threading.Thread(target=cleanup_task, daemon=True, name="Delivery-Cleanup")
+        thread.start()
+
+    def record_sent(self, modem_name, references, destination):
+        """Remember a sent message under the TP-MR reference of each of its parts"""
+        record = {'modem': modem_name, 'destination': destination, 'sent_at': time.time(),
+                  'parts_pending': len(references), 'failed': False}
+        with self.lock:
+            self.stats[modem_name]['sent'] += 1
+            for reference in references:
+                key = (modem_name, reference)
+                previous = self.pending.pop(key, None)
+                if previous is not None and not previous.get('expired'):
+                    # The 8-bit reference wrapped around before the old message got a report
+                    previous['expired'] = True
+                    self.stats[modem_name]['expired'] += 1
+                self.pending[key] = record
+            while len(self.pending) > self.max_entries:
+                self.expire_oldest()
+
+    def record_report(self, modem_name, reference, status):
+        """Match a status report (TP-ST value) to its send; returns the record once the message is final"""
+        if 0x20 <= status < 0x40:
+            return None  # Temporary error, the SMSC is still trying
+        with self.lock:
+            record = self.pending.pop((modem_name, reference), None)
+            if record is None:
+                self.logger.debug(f"Status report for unknown reference {reference} on {modem_name}")
+                return None
+            if record.get('expired'):
+                return None  # Already counted when another part expired
+            if status >= 0x40:
+                record['failed'] = True
+            record['parts_pending'] -= 1
+            if record['parts_pending'] > 0:
+                return None
+            stats = self.stats[modem_name]
+            if record['failed']:
+                stats['failed'] += 1
+            else:
+                latency = time.time() - record['sent_at']
+                stats['delivered'] += 1
+                stats['latency_sum'] += latency
+                stats['latency_buckets'][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        if record['failed']:
+            self.logger.warning(f"Delivery failed for SMS from {modem_name} to {record['destination']} (status {status})")
+        else:
+            self.logger.info(f"SMS from {modem_name} to {record['destination']} delivered after {latency:.1f}s")
+        return record
+
+    def expire_oldest(self):
+        """Drop the oldest pending entry, counting its message as expired (caller holds the lock)"""
+        key, record = self.pending.popitem(last=False)
+        if not record.get('expired'):
+            record['expired'] = True
+            self.stats[key[0]]['expired'] += 1
+
+    def expire_pending(self):
+        cutoff = time.time() - self.ttl_seconds
+        with self.lock:
+            while self.pending:
+                record = next(iter(self.pending.values()))
+                if record['sent_at'] > cutoff:
+                    break
+                self.expire_oldest()
+
+    def success_rate(self, modem_name):
+        """Smoothed share of resolved messages that were delivered (0.5 with no history)"""
+        with self.lock:
+            stats = self.stats.get(modem_name)
+            if stats is None:
+                return 0.5
+            resolved = stats['delivered'] + stats['failed'] + stats['expired']
+            return (stats['delivered'] + 1) / (resolved + 2)
+
+    def get_stats(self):
+        with self.lock:
+            result = {}
+            for modem_name, stats in self.stats.items():
+                delivered = stats['delivered']
+                result[modem_name] = {
+                    'sent': stats['sent'],
+                    'delivered': delivered,
+                    'failed': stats['failed'],
+                    'expired': stats['expired'],
+                    'pending': sum(1 for key in self.pending if key[0] == modem_name),
+                    'mean_latency': stats['latency_sum'] / delivered if delivered else None,
+                    'latency_histogram': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], stats['latency_buckets']))
+                }
+            return result
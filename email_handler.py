@@ -1,7 +1,6 @@
 import threading
 import queue
 import logging
-import time
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -20,6 +19,9 @@ class EmailHandler:
         self.smtp = None
         self.max_retries = retry_settings.get('max_retries', 3)
         self.initial_delay = retry_settings.get('initial_delay', 10)
+        self.stop_event = threading.Event()
+        self.pending = []  # Messages set aside during shutdown
+        self.in_flight = {}  # { worker thread ident: message it is handling }
         self.keep_alive = config.get('keep_alive', True)
 
     def start(self):
@@ -56,8 +58,18 @@ class EmailHandler:
 
     def process_email_queue(self):
         self.logger.debug(f"Starting email processor for {self.name}")
+        ident = threading.get_ident()
         while True:
+            self.in_flight.pop(ident, None)
             message = self.email_queue.get()
+            if message is None:
+                self.email_queue.task_done()
+                if not self.email_queue.empty():
+                    self.email_queue.put(None)  # Let retried messages drain first
+                    continue
+                self.close()
+                break
+            self.in_flight[ident] = message
             self.logger.debug(f"Processing email on {self.name}: {message}, queue size: {self.email_queue.qsize()}")
             retry_count = message.get('retry_count', 0)
 
@@ -87,11 +99,17 @@ class EmailHandler:
             return False
 
     def retry_message(self, message, retry_count):
+        if self.stop_event.is_set():
+            self.pending.append(message)
+            return
         if retry_count < self.max_retries:
             delay = self.initial_delay * (2 ** retry_count)
             self.logger.info(f"Retrying email to {message['destination']} (attempt {retry_count + 1}/{self.max_retries}) after {delay}s")
             message['retry_count'] = retry_count + 1
-            time.sleep(delay)
+            if self.stop_event.wait(delay):
+                # Stopped mid-backoff: the email goes into the snapshot unsent
+                self.pending.append(message)
+                return
             self.email_queue.put(message)
         else:
             self.logger.error(f"Max retries ({self.max_retries}) reached for email to {message['destination']}")
@@ -99,6 +117,44 @@ class EmailHandler:
     def send_email(self, destination, text):
         self.email_queue.put({'destination': destination, 'text': text, 'retry_count': 0})
 
+    def begin_shutdown(self):
+        """Stop retrying: failed messages are kept in pending instead of being backed off"""
+        self.stop_event.set()
+
+    def is_idle(self):
+        return self.email_queue.unfinished_tasks == 0
+
+    def take_pending(self):
+        """Remove and return every queued or set-aside message; a stop sentinel stays queued"""
+        messages = self.pending
+        self.pending = []
+        stopping = False
+        while True:
+            try:
+                message = self.email_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.email_queue.task_done()
+            if message is None:
+                stopping = True
+            else:
+                messages.append(message)
+        if stopping:
+            self.email_queue.put(None)  # Workers still need it to exit
+        return messages
+
+    def take_in_flight(self):
+        """Return the messages workers are handling right now (they stay with the workers)"""
+        return list(self.in_flight.values())
+
+    def restore_pending(self, messages):
+        for message in messages:
+            self.email_queue.put(message)
+
+    def stop(self):
+        """Stop the worker thread once queued messages are handled"""
+        self.email_queue.put(None)
+
     def close(self):
         if self.smtp:
             self.smtp.quit()
@@ -0,0 +1,53 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+EXPORT_FIELDS = ('modem', 'sender', 'timestamp', 'text')
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def parse_time(value):
+    """Parse an epoch-seconds or ISO 8601 filter value into a datetime"""
+    if value is None or value == '':
+        return None
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'  # fromisoformat only accepts 'Z' from Python 3.11
+        return datetime.fromisoformat(value)
+
+def iter_ndjson(records, chunk_size=500):
+    """Yield NDJSON text in chunks of up to chunk_size records"""
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, ensure_ascii=False))
+        if len(lines) >= chunk_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+def iter_csv(records, chunk_size=500):
+    """Yield CSV text (with header) in chunks of up to chunk_size records"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow(record)
+        count += 1
+        if count >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def export_records(records, fmt='ndjson', chunk_size=500):
+    if fmt == 'ndjson':
+        return iter_ndjson(records, chunk_size)
+    if fmt == 'csv':
+        return iter_csv(records, chunk_size)
+    raise ValueError(f"Unsupported export format: {fmt}")
@@ -1,11 +1,22 @@
+import json
 import logging
+import os
+import signal
+import socket
+import sqlite3
 import threading
+import time
 from modem import ModemHandler
 from email_handler import EmailHandler
 from api_handler import ApiHandler
 from sms_processor import SMSProcessor
 from memory_store import MemoryStore
 from config import ConfigManager
+from admin_server import AdminServer, BodyTooLarge
+from export import parse_time, export_records, CONTENT_TYPES
+from delivery_tracker import DeliveryTracker
+from shared_queue import SharedQueue
+from profiler import SamplingProfiler, dump_thread_stacks, thread_cpu_times
 
 class SmsGateway:
     def __init__(self, config_file='config.json'):
@@ -18,60 +29,505 @@ class SmsGateway:
         self.processor = SMSProcessor(
             self.memory_store,
             self.config_manager.get_rules(),
-            multipart_timeout_minutes=self.config_manager.get_multipart_timeout_minutes()
+            multipart_timeout_minutes=self.config_manager.get_multipart_timeout_minutes(),
+            dedup_ttl_seconds=self.config_manager.get_dedup_ttl_seconds(),
+            dedup_max_entries=self.config_manager.get_dedup_max_entries(),
+            rate_limits=self.config_manager.get_rate_limits()
         )
+        self.delivery_tracker = DeliveryTracker(ttl_seconds=self.config_manager.get_delivery_report_ttl())
+        self.processor.delivery_tracker = self.delivery_tracker
         self.modem_handlers = {}
         self.email_handlers = {}
         self.api_handlers = {}
+        self.admin_server = None
+        self.reload_lock = threading.Lock()
+        self.reload_requested = threading.Event()
+        self.modem_ready = threading.Event()
+        self.shutdown_requested = threading.Event()
+        self.shared_queue = None
+        self.shared_in_flight = set()  # Ids of shared-queue messages leased by this node
+        self.shared_lock = threading.Lock()
+        self.unrestored = None  # Snapshot entries with no handler at startup, carried into the next snapshot
+        profiling_conf = self.config_manager.get_profiling_config()
+        self.profiler = SamplingProfiler(
+            output_dir=profiling_conf.get('output_dir', 'profiles'),
+            interval=profiling_conf.get('interval', 0.005)
+        )
 
     def start(self):
         self.logger.debug("Starting SMS Gateway")
-        
-        for modem_conf in self.config_manager.get_modem_configs():
-            handler = ModemHandler(modem_conf, self.processor.process_sms, self.config_manager.get_retry_settings())
-            self.modem_handlers[modem_conf['name']] = handler
-            self.processor.register_modem(modem_conf['port'], handler)
-            if handler.start():
-                self.logger.debug(f"Started thread for modem {modem_conf['name']}")
-        
+
+        modem_configs = self.config_manager.get_modem_configs()
+        for modem_conf in modem_configs:
+            self.start_modem(modem_conf)
+
         for email_conf in self.config_manager.get_email_configs():
-            handler = EmailHandler(email_conf, self.config_manager.get_retry_settings())
-            self.email_handlers[email_conf['name']] = handler
-            self.processor.register_email(email_conf['name'], handler)
-            if handler.start():
-                self.logger.debug(f"Started thread for email {email_conf['name']}")
-        
-        for api_conf in self.config_manager.config.get('api_providers', []):
-            handler = ApiHandler(api_conf, self.config_manager.get_retry_settings())
-            self.api_handlers[api_conf['name']] = handler
-            self.processor.register_api(api_conf['name'], handler)
-            if handler.start():
-                self.logger.debug(f"Started thread for api {api_conf['name']}")
+            self.start_email(email_conf)
+
+        for api_conf in self.config_manager.get_api_configs():
+            self.start_api(api_conf)
+
+        self.restore_snapshot()
+        self.start_shared_queue()
+        self.start_config_watcher()
+        self.start_admin_server()
+
+        if modem_configs:
+            timeout = self.config_manager.get_modem_startup_timeout()
+            if self.modem_ready.wait(timeout=timeout):
+                self.logger.info("SMS Gateway ready")
+            else:
+                self.logger.warning(f"No modem connected within {timeout}s, continuing while connections are retried")
+
+    def start_modem(self, modem_conf):
+        """Register a modem handler and connect it in the background; messages queue until it is up"""
+        handler = ModemHandler(modem_conf, self.processor.process_sms, self.config_manager.get_retry_settings(),
+                               delivery_tracker=self.delivery_tracker)
+        self.modem_handlers[modem_conf['name']] = handler
+        self.processor.register_modem(modem_conf['port'], handler)
+        handler.reroute_callback = self.reroute_message
+        handler.result_callback = self.shared_message_done
+        handler.start_async(on_connected=self.modem_connected)
+
+    def modem_connected(self, handler):
+        self.logger.debug(f"Started thread for modem {handler.name}")
+        self.modem_ready.set()
+
+    def start_email(self, email_conf):
+        handler = EmailHandler(email_conf, self.config_manager.get_retry_settings())
+        self.email_handlers[email_conf['name']] = handler
+        self.processor.register_email(email_conf['name'], handler)
+        if handler.start():
+            self.logger.debug(f"Started thread for email {email_conf['name']}")
+
+    def start_api(self, api_conf):
+        handler = ApiHandler(api_conf, self.config_manager.get_retry_settings())
+        self.api_handlers[api_conf['name']] = handler
+        self.processor.register_api(api_conf['name'], handler)
+        if handler.start():
+            self.logger.debug(f"Started thread for api {api_conf['name']}")
+
+    def start_admin_server(self):
+        admin_conf = self.config_manager.get_admin_server_config()
+        if not admin_conf.get('enabled', False):
+            return
+        self.admin_server = AdminServer(admin_conf)
+        self.admin_server.add_route('POST', '/sms', self.handle_submit_sms)
+        self.admin_server.add_route('POST', '/sms/bulk', self.handle_submit_bulk)
+        self.admin_server.add_route('GET', '/export', self.handle_export)
+        self.admin_server.add_route('GET', '/stats/delivery', lambda request, query: (200, self.delivery_tracker.get_stats()))
+        self.admin_server.add_route('GET', '/debug/threads', lambda request, query: (200, iter([dump_thread_stacks()]), 'text/plain'))
+        self.admin_server.add_route('GET', '/debug/cpu', lambda request, query: (200, thread_cpu_times()))
+        self.admin_server.add_route('GET', '/debug/profile', self.handle_profile)
+        if self.shared_queue:
+            self.admin_server.add_route('GET', '/stats/shared-queue', lambda request, query: (200, self.shared_queue.get_stats()))
+        self.admin_server.start()
+
+    def handle_submit_sms(self, request, query):
+        """POST /sms with {"destination": ..., "text": ..., "modem": optional}"""
+        message = json.loads(self.admin_server.read_body(request))
+        if not isinstance(message, dict):
+            raise ValueError("expected a JSON object")
+        modem_name, error = self.processor.submit_sms(message.get('destination'), message.get('text'), message.get('modem'))
+        if error:
+            return 400, {'error': error}
+        return 202, {'queued': True, 'modem': modem_name}
+
+    def handle_submit_bulk(self, request, query):
+        """POST /sms/bulk with a JSON array, or NDJSON (one message per line) which is processed as it is read"""
+        content_type = request.headers.get('Content-Type', '')
+        if 'ndjson' in content_type or 'jsonlines' in content_type:
+            messages = self.admin_server.iter_lines(request)
+        else:
+            messages = json.loads(self.admin_server.read_body(request))
+            if not isinstance(messages, list):
+                raise ValueError("expected a JSON array")
+        accepted = 0
+        rejected = []
+        body_error = None
+        shared_batch = []  # Shared-queue messages, inserted in one transaction at the end
+        shared_indexes = []
+        lines = enumerate(messages)
+        while True:
+            try:
+                index, message = next(lines)
+            except StopIteration:
+                break
+            except (ValueError, BodyTooLarge) as e:
+                # The body broke off mid-stream; report what was queued so the client resends only the rest
+                body_error = str(e) or "request body too large"
+                break
+            if isinstance(message, bytes):
+                try:
+                    message = json.loads(message)
+                except ValueError as e:
+                    rejected.append({'index': index, 'error': f"invalid JSON: {e}"})
+                    continue
+            if not isinstance(message, dict):
+                rejected.append({'index': index, 'error': "expected a JSON object"})
+                continue
+            try:
+                modem_name, error = self.processor.submit_sms(message.get('destination'), message.get('text'),
+                                                              message.get('modem'), shared_batch=shared_batch)
+            except Exception as e:
+                # Earlier lines are already queued, so a bad line must not fail the whole request
+                self.logger.error(f"Bulk submission line {index} failed: {e}")
+                error = "internal error"
+            if error:
+                rejected.append({'index': index, 'error': error})
+            elif modem_name is None:
+                shared_indexes.append(index)
+            else:
+                accepted += 1
+        if shared_batch:
+            try:
+                accepted += self.processor.shared_queue.enqueue_many(shared_batch)
+            except sqlite3.Error as e:
+                self.logger.error(f"Failed to queue {len(shared_batch)} bulk message(s) to the shared queue: {e}")
+                rejected.extend({'index': index, 'error': "internal error"} for index in shared_indexes)
+                rejected.sort(key=lambda item: item['index'])
+        self.logger.info(f"Bulk submission: {accepted} queued, {len(rejected)} rejected"
+                         f"{f', body error: {body_error}' if body_error else ''}")
+        result = {'accepted': accepted, 'rejected': rejected, 'processed': accepted + len(rejected)}
+        if body_error:
+            result['error'] = body_error
+        return 202 if accepted or not (rejected or body_error) else 400, result
+
+    def handle_export(self, request, query):
+        """GET /export?format=ndjson|csv&since=...&until=...&sender=... streams the in-memory store"""
+        fmt = query.get('format', 'ndjson')
+        if fmt not in CONTENT_TYPES:
+            raise ValueError(f"Unsupported export format: {fmt}")
+        since = parse_time(query.get('since'))
+        until = parse_time(query.get('until'))
+        records = self.memory_store.iter_sms(
+            since=since.timestamp() if since else None,
+            until=until.timestamp() if until else None,
+            sender=query.get('sender')
+        )
+        return 200, export_records(records, fmt), CONTENT_TYPES[fmt]
+
+    def handle_profile(self, request, query):
+        """GET /debug/profile?seconds=N samples all threads for N seconds and returns the written file paths"""
+        profiling_conf = self.config_manager.get_profiling_config()
+        seconds = float(query.get('seconds', profiling_conf.get('duration', 10)))
+        max_duration = profiling_conf.get('max_duration', 60)
+        if not 0 < seconds <= max_duration:
+            raise ValueError(f"seconds must be between 0 and {max_duration}")
+        try:
+            return 200, self.profiler.profile(seconds)
+        except RuntimeError as e:
+            return 409, {'error': str(e)}
+
+    def install_debug_signals(self):
+        """SIGUSR1 logs thread stacks and CPU times, SIGUSR2 runs a background profile"""
+        if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+            return
+        def dump_stacks(signum, frame):
+            self.logger.warning(f"Thread stacks:\n{dump_thread_stacks()}")
+            self.logger.warning(f"Thread CPU times: {thread_cpu_times()}")
+        def start_profile(signum, frame):
+            profiling_conf = self.config_manager.get_profiling_config()
+            duration = min(profiling_conf.get('duration', 10), profiling_conf.get('max_duration', 60))
+            threading.Thread(target=self.run_profile, args=(duration,), daemon=True, name="Profiler").start()
+        signal.signal(signal.SIGUSR1, dump_stacks)
+        signal.signal(signal.SIGUSR2, start_profile)
+
+    def run_profile(self, duration):
+        try:
+            self.profiler.profile(duration)
+        except RuntimeError as e:
+            self.logger.warning(f"Profile not started: {e}")
+
+    def start_shared_queue(self):
+        """In scale-out mode, lease messages from the queue shared by all nodes whenever local modems have room"""
+        scale_conf = self.config_manager.get_scale_out_config()
+        if not scale_conf.get('enabled', False):
+            return
+        self.shared_queue = SharedQueue(
+            scale_conf['database'],
+            scale_conf.get('node_id', socket.gethostname()),
+            lease_seconds=scale_conf.get('lease_seconds', 300),
+            max_claims=scale_conf.get('max_claims', 5)
+        )
+        self.processor.shared_queue = self.shared_queue
+        poll_interval = scale_conf.get('poll_interval', 1)
+        max_in_flight = scale_conf.get('max_in_flight_per_modem', 2)
+        def claim_task():
+            last_renewal = time.monotonic()
+            while not self.shutdown_requested.wait(timeout=poll_interval):
+                try:
+                    if time.monotonic() - last_renewal >= self.shared_queue.lease_seconds / 3:
+                        with self.shared_lock:
+                            in_flight = list(self.shared_in_flight)
+                        self.shared_queue.renew(in_flight)
+                        last_renewal = time.monotonic()
+                    self.claim_shared_messages(max_in_flight)
+                except sqlite3.Error as e:
+                    self.logger.error(f"Shared queue error: {e}")
+        thread = threading.Thread(target=claim_task, daemon=True, name="Shared-Queue")
+        thread.start()
+        self.logger.info(f"Scale-out enabled: node {self.shared_queue.node_id} sharing {scale_conf['database']}")
+
+    def claim_shared_messages(self, max_in_flight):
+        """Claim as many shared messages as healthy local modems have free queue slots, and queue them locally"""
+        capacity = sum(max(0, max_in_flight - h.outgoing_queue.qsize())
+                       for h in self.modem_handlers.values() if h.healthy.is_set())
+        if capacity == 0:
+            return
+        messages = self.shared_queue.claim(capacity)
+        for message in messages:
+            modem_name = self.processor.pick_modem(healthy_only=True)
+            if modem_name is None:
+                self.shared_queue.release([message['shared_id']], count_claim=False)
+                continue
+            with self.shared_lock:
+                self.shared_in_flight.add(message['shared_id'])
+            self.modem_handlers[modem_name].outgoing_queue.put(message)
+        if messages:
+            self.logger.debug(f"Claimed {len(messages)} shared message(s)")
+
+    def shared_message_done(self, handler, message, success):
+        """Remove a sent shared message, or give a failed one back so another node can try it"""
+        shared_id = message.get('shared_id')
+        if shared_id is None:
+            return
+        with self.shared_lock:
+            self.shared_in_flight.discard(shared_id)
+        try:
+            if success:
+                self.shared_queue.complete(shared_id)
+            else:
+                self.shared_queue.release([shared_id])
+        except sqlite3.Error as e:
+            self.logger.error(f"Failed to update shared message {shared_id}: {e}; its lease will expire")
+
+    def reroute_message(self, handler, message):
+        """Move a message off an unhealthy modem; shared messages no local modem can take go back to the other nodes"""
+        if self.processor.reroute_sms(handler, message):
+            return True
+        if self.shared_queue and 'shared_id' in message:
+            self.release_shared_messages([message])
+            return True
+        return False
+
+    def release_shared_messages(self, messages):
+        """Give leased shared messages back without counting the claim; returns the local messages"""
+        shared_ids = [m['shared_id'] for m in messages if 'shared_id' in m]
+        if shared_ids:
+            with self.shared_lock:
+                self.shared_in_flight.difference_update(shared_ids)
+            try:
+                self.shared_queue.release(shared_ids, count_claim=False)
+                self.logger.info(f"Released {len(shared_ids)} shared message(s) for other nodes")
+            except sqlite3.Error as e:
+                self.logger.error(f"Failed to release shared messages: {e}; their leases will expire")
+        return [m for m in messages if 'shared_id' not in m]
+
+    def start_config_watcher(self):
+        """Start a thread that applies config changes from SIGHUP or file modification"""
+        def watch_task():
+            while True:
+                interval = self.config_manager.get_config_reload_interval()
+                self.reload_requested.wait(timeout=interval if interval > 0 else None)
+                if self.reload_requested.is_set() or self.config_manager.config_changed():
+                    self.reload_requested.clear()
+                    self.reload_config()
+        thread = threading.Thread(target=watch_task, daemon=True, name="Config-Watcher")
+        thread.start()
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_requested.set())
+        self.logger.debug("Started config watcher")
+
+    def reload_config(self):
+        """Reload config.json and apply rule and provider changes without restarting unchanged modems"""
+        with self.reload_lock:
+            if not self.config_manager.reload_config():
+                return False
+
+            self.processor.update_rules(self.config_manager.get_rules(), self.config_manager.get_rate_limits())
+            self.sync_handlers(self.modem_handlers, self.config_manager.get_modem_configs(),
+                               self.start_modem, self.processor.unregister_modem,
+                               stop_func=lambda handler: handler.stop_async(self.modem_stopped))
+            self.sync_handlers(self.email_handlers, self.config_manager.get_email_configs(),
+                               self.start_email, self.processor.unregister_email)
+            self.sync_handlers(self.api_handlers, self.config_manager.get_api_configs(),
+                               self.start_api, self.processor.unregister_api)
+            return True
+
+    def sync_handlers(self, handlers, configs, start_func, unregister_func, stop_func=None):
+        """Stop removed or changed handlers and start new or changed ones; stop_func must not block"""
+        new_configs = {conf['name']: conf for conf in configs}
+        retry_settings = self.config_manager.get_retry_settings()
+        leftover = {}
+        for name, handler in list(handlers.items()):
+            new_conf = new_configs.get(name)
+            if new_conf is not None and new_conf == handler.config:
+                handler.max_retries = retry_settings.get('max_retries', 3)
+                handler.initial_delay = retry_settings.get('initial_delay', 10)
+                continue
+            self.logger.info(f"{'Restarting changed' if new_conf is not None else 'Removing'} handler {name}")
+            unregister_func(name)
+            del handlers[name]
+            leftover[name] = handler.take_pending()
+            if stop_func:
+                stop_func(handler)
+            else:
+                handler.stop()
+        for name, conf in new_configs.items():
+            if name not in handlers:
+                self.logger.info(f"Starting handler {name}")
+                start_func(conf)
+                handlers[name].restore_pending(leftover.pop(name, []))
+        for name, messages in leftover.items():
+            if self.shared_queue:
+                messages = self.release_shared_messages(messages)
+            if messages:
+                self.logger.warning(f"Dropped {len(messages)} pending message(s) of removed handler {name}")
+
+    def modem_stopped(self, handler, messages):
+        """Hand messages a modem set aside while stopping for a reload to its replacement, if there is one"""
+        if not messages:
+            return
+        with self.reload_lock:
+            replacement = self.modem_handlers.get(handler.name)
+            if replacement is not None and not self.shutdown_requested.is_set():
+                replacement.restore_pending(messages)
+                return
+        if self.shared_queue:
+            messages = self.release_shared_messages(messages)
+        if messages:
+            self.logger.warning(f"Dropped {len(messages)} pending message(s) of removed modem {handler.name}")
 
     def run(self):
         self.start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown_requested.set())
+        self.install_debug_signals()
         try:
-            threading.Event().wait()
+            while not self.shutdown_requested.wait(timeout=1):
+                pass
         except KeyboardInterrupt:
-            self.logger.info("Shutting down...")
-            for handler in self.modem_handlers.values():
-                handler.close()
-            for handler in self.email_handlers.values():
-                handler.close()
-            for handler in self.api_handlers.values():
-                handler.close()
-            for handler_dict in [self.modem_handlers, self.email_handlers, self.api_handlers]:
-                for handler in handler_dict.values():
-                    if hasattr(handler, 'incoming_queue'):
-                        handler.incoming_queue.join()
-                    if hasattr(handler, 'outgoing_queue'):
-                        handler.outgoing_queue.join()
-                    if hasattr(handler, 'email_queue'):
-                        handler.email_queue.join()
-                    if hasattr(handler, 'api_queue'):
-                        handler.api_queue.join()
-            self.logger.info("All queues processed, shutdown complete.")
+            pass
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop intake, drain queues until the deadline, then snapshot what is left for the next start"""
+        timeout = self.config_manager.get_shutdown_timeout()
+        self.logger.info(f"Shutting down (deadline {timeout}s)...")
+        deadline = time.monotonic() + timeout
+        self.shutdown_requested.set()  # Also stops claiming from the shared queue
+        if self.admin_server:
+            self.admin_server.close()
+
+        all_handlers = [h for d in (self.modem_handlers, self.email_handlers, self.api_handlers) for h in d.values()]
+        for handler in all_handlers:
+            handler.begin_shutdown()
+        while not all(handler.is_idle() for handler in all_handlers):
+            if time.monotonic() >= deadline:
+                self.logger.warning("Shutdown deadline reached with messages still queued")
+                break
+            time.sleep(0.1)
+
+        for handler in self.modem_handlers.values():
+            handler.close()
+        # Workers may still be mid-send at the deadline; their messages go into the snapshot too, since a
+        # failure after this point could no longer be saved (a late success means a duplicate on restore)
+        sending = {}
+        for handlers in (self.modem_handlers, self.email_handlers, self.api_handlers):
+            for name, handler in handlers.items():
+                sending[id(handler)] = handler.take_in_flight()
+        snapshot = {
+            'modems': {name: {'outgoing': self.take_unfinished(h, sending[id(h)]), 'incoming': h.take_incoming()}
+                       for name, h in self.modem_handlers.items()},
+            'email': {name: self.take_unfinished(h, sending[id(h)]) for name, h in self.email_handlers.items()},
+            'api': {name: self.take_unfinished(h, sending[id(h)]) for name, h in self.api_handlers.items()}
+        }
+        if self.shared_queue:
+            # Queued shared messages go back to the other nodes; ones still being sent keep their lease,
+            # so a late success deletes them and a failure leaves them for another node once it expires
+            for messages in snapshot['modems'].values():
+                messages['outgoing'] = self.release_shared_messages(messages['outgoing'])
+            sending_ids = {m['shared_id'] for h in self.modem_handlers.values() for m in sending[id(h)] if 'shared_id' in m}
+            with self.shared_lock:
+                stray = [shared_id for shared_id in self.shared_in_flight if shared_id not in sending_ids]
+            self.release_shared_messages([{'shared_id': shared_id} for shared_id in stray])
+        if self.unrestored:
+            for name, messages in self.unrestored['modems'].items():
+                entry = snapshot['modems'].setdefault(name, {'outgoing': [], 'incoming': []})
+                entry['outgoing'].extend(messages['outgoing'])
+                entry['incoming'].extend(messages['incoming'])
+            for key in ('email', 'api'):
+                for name, messages in self.unrestored[key].items():
+                    snapshot[key].setdefault(name, []).extend(messages)
+        for handler in self.email_handlers.values():
+            handler.close()
+        for handler in self.api_handlers.values():
+            handler.close()
+        self.write_snapshot(snapshot)
+        self.logger.info("Shutdown complete.")
+
+    def take_unfinished(self, handler, sending):
+        """Queued and set-aside messages of a handler plus those its workers were sending; shared ones still being
+        sent stay out of the local snapshot"""
+        messages = handler.take_pending()
+        for message in sending:
+            if 'shared_id' not in message and not any(message is m for m in messages):
+                messages.append(message)
+        return messages
+
+    def write_snapshot(self, snapshot):
+        spool_file = self.config_manager.get_spool_file()
+        count = (sum(len(m['outgoing']) + len(m['incoming']) for m in snapshot['modems'].values())
+                 + sum(len(m) for m in snapshot['email'].values())
+                 + sum(len(m) for m in snapshot['api'].values()))
+        if count == 0:
+            self.logger.info("All queues processed, nothing to snapshot")
+            return
+        tmp_file = f"{spool_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, spool_file)
+        self.logger.info(f"Saved {count} unprocessed message(s) to {spool_file} for replay")
+
+    def restore_snapshot(self):
+        """Requeue messages saved by the previous shutdown"""
+        spool_file = self.config_manager.get_spool_file()
+        if not os.path.exists(spool_file):
+            return
+        try:
+            with open(spool_file, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Failed to read snapshot {spool_file}: {e}")
+            return
+        kept = {'modems': {}, 'email': {}, 'api': {}}  # Entries with nowhere to go stay in the spool file
+        for name, messages in snapshot.get('modems', {}).items():
+            handler = self.modem_handlers.get(name)
+            if handler is None:
+                fallback = self.processor.pick_modem()
+                if fallback is None:
+                    kept['modems'][name] = {'outgoing': messages.get('outgoing', []), 'incoming': messages.get('incoming', [])}
+                    self.logger.warning(f"Kept {len(messages.get('outgoing', []))} outgoing and {len(messages.get('incoming', []))} "
+                                        f"incoming snapshot message(s) for unknown modem {name} in {spool_file}")
+                    continue
+                handler = self.modem_handlers[fallback]
+            handler.restore_pending(messages.get('outgoing', []))
+            handler.restore_incoming(messages.get('incoming', []))
+        for handlers, key in ((self.email_handlers, 'email'), (self.api_handlers, 'api')):
+            for name, messages in snapshot.get(key, {}).items():
+                if name in handlers:
+                    handlers[name].restore_pending(messages)
+                elif messages:
+                    kept[key][name] = messages
+                    self.logger.warning(f"Kept {len(messages)} snapshot message(s) for unknown {key} provider {name} in {spool_file}")
+        if any(kept.values()):
+            self.write_snapshot(kept)
+            self.unrestored = kept
+        else:
+            os.remove(spool_file)
+        self.logger.info(f"Restored queued messages from {spool_file}")
 
 if __name__ == "__main__":
     gateway = SmsGateway()
-    gateway.run()
\ No newline at end of file
+    gateway.run()
@@ -1,12 +1,15 @@
+import bisect
 import logging
 import threading
 import time
-from collections import deque
+from datetime import datetime
 
 class MemoryStore:
     def __init__(self, retention_days):
         self.logger = logging.getLogger(__name__)
-        self.sms_store = deque()  # List of (modem_name, number, timestamp, text) tuples
+        self.sms_store = []  # List of (modem_name, number, timestamp, text) tuples, oldest first
+        self.sms_times = []  # Timestamps of sms_store, kept in parallel for bisecting
+        self.base_seq = 0  # Sequence number of sms_store[0], advanced as old messages are removed
         self.store_lock = threading.Lock()
         self.retention_seconds = retention_days * 86400  # Convert days to seconds
         self.start_cleanup_thread()
@@ -26,13 +29,11 @@ class MemoryStore:
         """Remove SMS messages older than retention period"""
         current_time = time.time()
         with self.store_lock:
-            initial_count = len(self.sms_store)
-            # Keep messages newer than retention period
-            self.sms_store = deque(
-                msg for msg in self.sms_store
-                if current_time - msg[2] <= self.retention_seconds
-            )
-            removed_count = initial_count - len(self.sms_store)
+            # Messages are appended in time order, so the expired ones are a prefix
+            removed_count = bisect.bisect_left(self.sms_times, current_time - self.retention_seconds)
+            del self.sms_store[:removed_count]
+            del self.sms_times[:removed_count]
+            self.base_seq += removed_count
             if removed_count > 0:
                 self.logger.info(f"Cleaned up {removed_count} old SMS messages")
             else:
@@ -41,10 +42,36 @@ class MemoryStore:
     def save_sms(self, modem_name, sms):
         """Save an SMS to the in-memory store"""
         with self.store_lock:
-            self.sms_store.append((modem_name, sms.number, time.time(), sms.text))
+            timestamp = time.time()
+            self.sms_store.append((modem_name, sms.number, timestamp, sms.text))
+            self.sms_times.append(timestamp)
         self.logger.info(f"Saved SMS from {sms.number} to memory store from {modem_name}")
 
     def get_all_sms(self):
-        """Retrieve all SMS messages (for debugging or export)"""
+        """Retrieve all SMS messages (for debugging)"""
         with self.store_lock:
-            return list(self.sms_store)
\ No newline at end of file
+            return list(self.sms_store)
+
+    def iter_sms(self, since=None, until=None, sender=None, chunk_size=500):
+        """Yield matching messages as dicts, copying at most chunk_size entries per lock acquisition"""
+        with self.store_lock:
+            start = bisect.bisect_left(self.sms_times, since) if since is not None else 0
+            seq = self.base_seq + start
+        while True:
+            with self.store_lock:
+                start = max(seq - self.base_seq, 0)
+                chunk = self.sms_store[start:start + chunk_size]
+                seq = self.base_seq + start + len(chunk)
+            if not chunk:
+                return
+            for modem_name, number, timestamp, text in chunk:
+                if until is not None and timestamp > until:
+                    return
+                if sender is not None and number != sender:
+                    continue
+                yield {
+                    'modem': modem_name,
+                    'sender': number,
+                    'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+                    'text': text
+                }
\ No newline at end of file
@@ -1,12 +1,18 @@
 import threading
 import queue
 import logging
-import time
-from gsmmodem.modem import GsmModem
-from gsmmodem.exceptions import TimeoutException
+from datetime import datetime
+import re
+from gsmmodem.modem import GsmModem, Sms, ReceivedSms, SentSms, StatusReport, CTRLZ
+from gsmmodem.exceptions import TimeoutException, CommandError
+from gsmmodem.util import lineStartingWith
+from gsmmodem.pdu import Concatenation, decodeSmsPdu
+from sms_encoder import SmsEncoder
+
+CMGL_PDU_RE = re.compile(r'^\+CMGL:\s*(\d+),\s*(\d+),')
 
 class ModemHandler:
-    def __init__(self, config, sms_callback, retry_settings):
+    def __init__(self, config, sms_callback, retry_settings, delivery_tracker=None):
         self.logger = logging.getLogger(__name__)
         self.config = config
         self.name = config.get('name', 'UnnamedModem')
@@ -15,16 +21,39 @@ class ModemHandler:
         self.outgoing_queue = queue.Queue()
         self.modem = None
         self.sms_callback = sms_callback
+        self.delivery_tracker = delivery_tracker
         self.max_retries = retry_settings.get('max_retries', 3)
         self.initial_delay = retry_settings.get('initial_delay', 10)
         self.network_retries = config.get('network_retries', 3)
+        self.reconnect_delay = config.get('reconnect_delay', 30)
+        self.max_reconnect_delay = config.get('max_reconnect_delay', 600)
+        self.encoder = SmsEncoder(cache_size=config.get('pdu_cache_size', 256),
+                                  request_status_report=config.get('request_status_report', True))
+        self.use_cmms = config.get('use_cmms', True)
+        self.drain_interval = config.get('drain_interval', 300)
+        self.drain_memories = config.get('drain_memories', ['SM', 'ME'])
+        self.watchdog_interval = config.get('watchdog_interval', 60)
+        self.watchdog_timeout = config.get('watchdog_timeout', 10)
+        self.watchdog_max_failures = config.get('watchdog_max_failures', 2)
+        self.healthy = threading.Event()
+        self.reconnect_lock = threading.Lock()
+        self.command_lock = threading.Lock()  # Serializes multi-command exchanges (sends, probes, drains) on the modem
+        self.reroute_callback = None  # func(handler, message) -> True if another modem took the message
+        self.result_callback = None  # func(handler, message, success) once a message is sent or given up on
+        self.on_connected = None
+        self.next_reference = 0
+        self.threads_started = False
+        self.stop_event = threading.Event()
+        self.pending = []  # Outgoing messages set aside during shutdown
+        self.in_flight = {}  # { worker thread ident: message it is handling }
 
     def start(self):
         self.logger.debug(f"Starting modem {self.name}")
         self.modem = GsmModem(
             self.config['port'],
             self.config['baudrate'],
-            smsReceivedCallbackFunc=self.handle_sms
+            smsReceivedCallbackFunc=self.handle_sms,
+            smsStatusReportCallback=self.handle_status_report
         )
         self.modem.smsTextMode = False
         try:
@@ -32,16 +61,47 @@ class ModemHandler:
             self.logger.info(f"Connected to modem {self.name}")
         except Exception as e:
             self.logger.error(f"Failed to connect to modem {self.name}: {e}")
+            try:
+                self.modem.close()
+            except Exception:
+                pass
+            self.modem = None
             return False
 
-        self.start_threads()
+        self.healthy.set()
+        if not self.threads_started:
+            self.start_threads()
         return True
 
+    def start_async(self, on_connected=None):
+        """Connect in a background thread, retrying failed connects with exponential backoff"""
+        if on_connected:
+            self.on_connected = on_connected
+        def connect_task():
+            delay = self.reconnect_delay
+            while not self.stop_event.is_set():
+                if self.start():
+                    if self.on_connected:
+                        self.on_connected(self)
+                    return
+                self.logger.info(f"Retrying connection to modem {self.name} in {delay}s")
+                self.stop_event.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+        thread = threading.Thread(target=connect_task, daemon=True, name=f"Connect-{self.name}")
+        thread.start()
+        return thread
+
     def handle_sms(self, sms):
         self.logger.debug(f"Received SMS on {self.name}")
         self.incoming_queue.put(sms)
 
+    def handle_status_report(self, report):
+        self.logger.debug(f"Received status report on {self.name} for reference {report.reference}")
+        if self.delivery_tracker:
+            self.delivery_tracker.record_report(self.name, report.reference, report.deliveryStatus)
+
     def start_threads(self):
+        self.threads_started = True
         incoming_thread = threading.Thread(
             target=self.process_incoming,
             args=(),
@@ -58,52 +118,349 @@ class ModemHandler:
         )
         outgoing_thread.start()
 
+        if self.drain_interval > 0:
+            drain_thread = threading.Thread(
+                target=self.process_drain,
+                args=(),
+                daemon=True,
+                name=f"Drain-{self.name}"
+            )
+            drain_thread.start()
+
+        if self.watchdog_interval > 0:
+            watchdog_thread = threading.Thread(
+                target=self.process_watchdog,
+                args=(),
+                daemon=True,
+                name=f"Watchdog-{self.name}"
+            )
+            watchdog_thread.start()
+
     def process_incoming(self):
         self.logger.debug(f"Starting incoming processor for {self.name}")
         while True:
             sms = self.incoming_queue.get()
+            if sms is None:
+                self.incoming_queue.task_done()
+                break
             self.logger.debug(f"Processing incoming SMS on {self.name}: {sms.text}, queue size: {self.incoming_queue.qsize()}")
             self.sms_callback(self.name, sms)
             self.incoming_queue.task_done()
 
+    def process_drain(self):
+        """Periodically recover messages left in SIM/ME storage, starting right after connect"""
+        self.logger.debug(f"Starting storage drain for {self.name}")
+        while self.threads_started and not self.stop_event.is_set():
+            if self.healthy.is_set():
+                self.drain_storage()
+            self.stop_event.wait(self.drain_interval)
+
+    def process_watchdog(self):
+        """Probe the modem periodically and reconnect it after consecutive failed probes"""
+        self.logger.debug(f"Starting watchdog for {self.name}")
+        failures = 0
+        while not self.stop_event.wait(self.watchdog_interval):
+            if not self.healthy.is_set():
+                failures = 0
+                continue
+            if self.probe():
+                failures = 0
+                continue
+            failures += 1
+            self.logger.warning(f"Watchdog probe failed on {self.name} ({failures}/{self.watchdog_max_failures})")
+            if failures >= self.watchdog_max_failures:
+                failures = 0
+                self.reconnect()
+
+    def probe(self):
+        try:
+            with self.command_lock:
+                self.modem.write('AT', timeout=self.watchdog_timeout)
+            return True
+        except Exception as e:
+            self.logger.debug(f"Probe on {self.name} failed: {e}")
+            return False
+
+    def reconnect(self):
+        """Mark the modem unhealthy, hand its queued messages to other modems and reconnect in the background"""
+        with self.reconnect_lock:
+            if not self.healthy.is_set() or self.stop_event.is_set():
+                return
+            self.healthy.clear()
+            self.logger.error(f"Modem {self.name} is unresponsive, reconnecting")
+            try:
+                self.modem.close()
+            except Exception:
+                pass
+            rerouted = 0
+            for message in self.take_queued():
+                if self.reroute_callback and self.reroute_callback(self, message):
+                    rerouted += 1
+                else:
+                    self.outgoing_queue.put(message)
+            if rerouted:
+                self.logger.info(f"Rerouted {rerouted} queued message(s) away from {self.name}")
+            self.start_async()
+
+    def drain_storage(self):
+        """List every stored message with one AT+CMGL per memory, process them and delete the handled ones"""
+        for memory in self.drain_memories:
+            self.drain_memory(memory)
+
+    def drain_memory(self, memory):
+        """Process the stored messages of one memory outside command_lock, then delete each one that was handled"""
+        with self.command_lock:
+            try:
+                messages = self.list_stored(memory)
+            except Exception as e:
+                self.logger.warning(f"Failed to list stored SMS in {memory} on {self.name}: {e}")
+                return
+        if not messages:
+            return
+        self.logger.info(f"Draining {len(messages)} stored message(s) from {memory} on {self.name}")
+        handled = []
+        for sms in messages:
+            try:
+                if isinstance(sms, StatusReport):
+                    self.handle_status_report(sms)
+                else:
+                    self.sms_callback(self.name, sms)
+            except Exception as e:
+                self.logger.error(f"Error processing stored SMS at index {sms.index} in {memory} on {self.name}: {e}")
+                continue
+            handled.append(sms.index)
+        for index in handled:
+            try:
+                with self.command_lock:
+                    self.modem.deleteStoredSms(index, memory=memory)
+            except Exception as e:
+                self.logger.warning(f"Failed to delete drained SMS at index {index} in {memory} on {self.name}: {e}")
+
+    def list_stored(self, memory):
+        """Received messages and status reports in memory with their indexes (caller holds command_lock).
+        Parses AT+CMGL itself: listStoredSms raises on a stored SMS-SUBMIT and drops status report indexes"""
+        # GsmModem has no public way to select the read memory; this keeps its cached selection in step
+        self.modem._setSmsMemory(readDelete=memory)
+        messages = []
+        index = None
+        for line in self.modem.write(f'AT+CMGL={Sms.STATUS_ALL}'):
+            match = CMGL_PDU_RE.match(line)
+            if match:
+                index, status = int(match.group(1)), int(match.group(2))
+                continue
+            if index is None:
+                continue
+            try:
+                pdu = decodeSmsPdu(line)
+            except Exception:
+                pdu = {'type': None}
+            if pdu['type'] == 'SMS-DELIVER':
+                messages.append(ReceivedSms(self.modem, status, pdu['number'], pdu['time'], pdu['text'],
+                                            pdu['smsc'], pdu.get('udh', []), index))
+            elif pdu['type'] == 'SMS-STATUS-REPORT':
+                report = StatusReport(self.modem, status, pdu['reference'], pdu['number'], pdu['time'],
+                                      pdu['discharge'], pdu['status'])
+                report.index = index
+                messages.append(report)
+            else:
+                self.logger.debug(f"Skipping stored {pdu['type'] or 'unreadable'} message at index {index} in {memory} on {self.name}")
+            index = None
+        return messages
+
     def process_outgoing(self):
         self.logger.debug(f"Starting outgoing processor for {self.name}")
+        ident = threading.get_ident()
         while True:
+            self.in_flight.pop(ident, None)
             message = self.outgoing_queue.get()
+            if message is None:
+                self.outgoing_queue.task_done()
+                if not self.outgoing_queue.empty():
+                    self.outgoing_queue.put(None)  # Let retried messages drain first
+                    continue
+                break
+            self.in_flight[ident] = message
             self.logger.debug(f"Processing outgoing message on {self.name}: {message}, queue size: {self.outgoing_queue.qsize()}")
             retry_count = message.get('retry_count', 0)
+
+            if not self.healthy.is_set():
+                if self.reroute_callback and self.reroute_callback(self, message):
+                    self.outgoing_queue.task_done()
+                    continue
+                # No other modem can take it: hold the message until this one is back
+                while not self.healthy.wait(timeout=5) and not self.stop_event.is_set():
+                    pass
             
             success = False
             for attempt in range(self.network_retries):
                 try:
                     if self.modem.waitForNetworkCoverage(timeout=30):
-                        self.modem.sendSms(message['destination'], message['text'])
+                        self.send_pdus(message['destination'], message['text'])
                         self.logger.info(f"Sent SMS from {self.name} to {message['destination']}: {message['text']}")
                         success = True
+                        if self.result_callback:
+                            self.result_callback(self, message, True)
                         break
                     else:
                         self.logger.warning(f"No network coverage on {self.name}, attempt {attempt + 1}/{self.network_retries}")
-                        time.sleep(5)
+                        if self.stop_event.wait(5):
+                            break
                 except Exception as e:
                     self.logger.error(f"Error sending SMS from {self.name}: {e}")
+                    if not self.probe():
+                        self.reconnect()
                     break
             if not success:
+                if not self.healthy.is_set() and self.reroute_callback and self.reroute_callback(self, message):
+                    self.outgoing_queue.task_done()
+                    continue
                 self.retry_message(message, retry_count)
             self.outgoing_queue.task_done()
 
+    def send_pdus(self, destination, text):
+        """Send all parts of a message back-to-back, keeping the link open between parts with AT+CMMS"""
+        # The +CMGS prompt and the PDU are separate writes; no probe or drain may slip in between
+        with self.command_lock:
+            reference = self.next_reference
+            pdus = self.encoder.encode(destination, text, reference)
+            more_messages = len(pdus) > 1 and self.use_cmms
+            if more_messages:
+                try:
+                    self.modem.write('AT+CMMS=1', timeout=5)
+                except CommandError:
+                    self.logger.info(f"Modem {self.name} does not support AT+CMMS, sending parts individually")
+                    self.use_cmms = more_messages = False
+            try:
+                references = []
+                for pdu_hex, tpdu_length in pdus:
+                    self.modem.write(f'AT+CMGS={tpdu_length}', timeout=5, expectedResponseTermSeq='> ')
+                    result = lineStartingWith('+CMGS:', self.modem.write(pdu_hex, timeout=35, writeTerm=CTRLZ))
+                    if result is None:
+                        raise CommandError('Modem did not respond with +CMGS response')
+                    references.append(int(result[7:]))
+            finally:
+                if more_messages:
+                    self.modem.write('AT+CMMS=0', timeout=5, parseError=False)
+            self.next_reference = (reference + 1) % 256
+            if self.delivery_tracker and self.encoder.request_status_report:
+                self.delivery_tracker.record_sent(self.name, references, destination)
+            return SentSms(destination, text, references[-1])
+
     def retry_message(self, message, retry_count):
-        if retry_count < self.max_retries:
+        if self.stop_event.is_set():
+            self.pending.append(message)
+            return
+        max_retries = message.get('max_retries', self.max_retries)
+        if retry_count < max_retries:
             delay = self.initial_delay * (2 ** retry_count)
-            self.logger.info(f"Retrying message to {message['destination']} (attempt {retry_count + 1}/{self.max_retries}) after {delay}s")
+            self.logger.info(f"Retrying message to {message['destination']} (attempt {retry_count + 1}/{max_retries}) after {delay}s")
             message['retry_count'] = retry_count + 1
-            time.sleep(delay)
+            if self.stop_event.wait(delay):
+                # Stopped or reloaded mid-backoff: set the SMS aside for the snapshot or the replacement modem
+                self.pending.append(message)
+                return
             self.outgoing_queue.put(message)
         else:
-            self.logger.error(f"Max retries ({self.max_retries}) reached for message to {message['destination']}")
+            self.logger.error(f"Max retries ({max_retries}) reached for message to {message['destination']}")
+            if self.result_callback:
+                self.result_callback(self, message, False)
 
     def send_sms(self, destination, text):
         self.outgoing_queue.put({'destination': destination, 'text': text, 'retry_count': 0})
 
+    def begin_shutdown(self):
+        """Stop retrying and reconnecting: failed messages are kept in pending instead of being backed off"""
+        self.stop_event.set()
+
+    def is_idle(self):
+        if not self.threads_started:
+            return True  # Nothing will be processed until a connect succeeds
+        return self.incoming_queue.unfinished_tasks == 0 and self.outgoing_queue.unfinished_tasks == 0
+
+    def take_pending(self):
+        """Remove and return every queued or set-aside outgoing message"""
+        messages = self.pending
+        self.pending = []
+        return messages + self.take_queued()
+
+    def take_queued(self):
+        """Remove and return the messages waiting in the outgoing queue"""
+        messages = []
+        while True:
+            try:
+                message = self.outgoing_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.outgoing_queue.task_done()
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    def take_incoming(self):
+        """Remove and return unprocessed incoming SMS as plain dicts"""
+        messages = []
+        while True:
+            try:
+                sms = self.incoming_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.incoming_queue.task_done()
+            if sms is None:
+                continue
+            message = {'number': sms.number, 'time': sms.time.isoformat(), 'text': sms.text}
+            # Keep the concatenation header so spooled parts are still reassembled on restore
+            for element in getattr(sms, 'udh', None) or []:
+                if isinstance(element, Concatenation):
+                    message['concatenation'] = {'reference': element.reference, 'parts': element.parts,
+                                                'number': element.number}
+            messages.append(message)
+        return messages
+
+    def take_in_flight(self):
+        """Return the messages workers are handling right now (they stay with the workers)"""
+        return list(self.in_flight.values())
+
+    def restore_pending(self, messages):
+        for message in messages:
+            self.outgoing_queue.put(message)
+
+    def restore_incoming(self, messages):
+        for message in messages:
+            udh = []
+            if 'concatenation' in message:
+                element = Concatenation()
+                element.reference = message['concatenation']['reference']
+                element.parts = message['concatenation']['parts']
+                element.number = message['concatenation']['number']
+                udh.append(element)
+            self.incoming_queue.put(type('SMS', (), {
+                'number': message['number'],
+                'time': datetime.fromisoformat(message['time']),
+                'text': message['text'],
+                'udh': udh
+            })())
+
+    def stop(self):
+        """Stop the worker threads after queued messages are handled and close the modem"""
+        self.stop_event.set()
+        if self.threads_started:
+            self.incoming_queue.put(None)
+            self.outgoing_queue.put(None)
+            self.incoming_queue.join()
+            self.outgoing_queue.join()
+            self.threads_started = False
+        self.close()
+
+    def stop_async(self, on_stopped=None):
+        """Run stop() in the background; on_stopped(handler, messages) gets what was set aside meanwhile"""
+        def stop_task():
+            self.stop()
+            if on_stopped:
+                on_stopped(self, self.take_pending())
+        thread = threading.Thread(target=stop_task, daemon=True, name=f"Stop-{self.name}")
+        thread.start()
+        return thread
+
     def close(self):
         if self.modem:
             self.modem.close()
@@ -0,0 +1,109 @@
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+def thread_names():
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+def dump_thread_stacks():
+    """Return the current stack of every thread as text"""
+    names = thread_names()
+    sections = []
+    for ident, frame in sys._current_frames().items():
+        stack = ''.join(traceback.format_stack(frame))
+        sections.append(f"Thread {names.get(ident, 'unknown')} ({ident}):\n{stack}")
+    return '\n'.join(sections)
+
+def thread_cpu_times():
+    """Return {thread_name: cpu_seconds} using per-thread CPU clocks (where the platform provides them)"""
+    times = {}
+    if not hasattr(time, 'pthread_getcpuclockid'):
+        return times
+    for thread in threading.enumerate():
+        try:
+            times[thread.name] = time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+        except (OSError, TypeError):
+            continue
+    return times
+
+class SamplingProfiler:
+    """Time-boxed sampling profiler over all threads; nothing runs unless a profile is requested"""
+
+    def __init__(self, output_dir='profiles', interval=0.005):
+        self.logger = logging.getLogger(__name__)
+        self.output_dir = output_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def profile(self, duration):
+        """Sample all thread stacks for duration seconds and write collapsed stacks and pstats files"""
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            self.logger.info(f"Profiling all threads for {duration}s")
+            stacks = Counter()
+            own_ident = threading.get_ident()
+            samples = 0
+            started = time.monotonic()
+            end = started + duration
+            while time.monotonic() < end:
+                names = thread_names()
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    stack.reverse()
+                    stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+                samples += 1
+                time.sleep(self.interval)
+            # Sampling itself takes time, so each sample stands for more than the sleep interval
+            sample_seconds = (time.monotonic() - started) / samples if samples else self.interval
+
+            os.makedirs(self.output_dir, exist_ok=True)
+            base = os.path.join(self.output_dir, time.strftime('profile-%Y%m%d-%H%M%S'))
+            self.write_collapsed(stacks, f"{base}.collapsed")
+            self.write_pstats(stacks, f"{base}.pstats", sample_seconds)
+            self.logger.info(f"Profile written to {base}.collapsed and {base}.pstats ({samples} samples)")
+            return {'samples': samples, 'collapsed': f"{base}.collapsed", 'pstats': f"{base}.pstats"}
+        finally:
+            self.lock.release()
+
+    def write_collapsed(self, stacks, path):
+        """Write one 'thread;frame;frame count' line per distinct stack (flame graph input)"""
+        with open(path, 'w') as f:
+            for (thread_name, stack), count in stacks.items():
+                frames = ';'.join(f"{name} ({os.path.basename(filename)}:{line})" for filename, line, name in stack)
+                f.write(f"{thread_name};{frames} {count}\n")
+
+    def write_pstats(self, stacks, path, sample_seconds):
+        """Write samples in the marshal format read by pstats.Stats, each sample counting as sample_seconds"""
+        own = Counter()
+        total = Counter()
+        callers = {}
+        for (_, stack), count in stacks.items():
+            if not stack:
+                continue
+            own[stack[-1]] += count
+            for func in set(stack):
+                total[func] += count
+            for caller, callee in zip(stack, stack[1:]):
+                edges = callers.setdefault(callee, Counter())
+                edges[caller] += count
+        stats = {}
+        for func, count in total.items():
+            func_callers = {
+                caller: (n, n, 0.0, n * sample_seconds)
+                for caller, n in callers.get(func, {}).items()
+            }
+            stats[func] = (count, count, own[func] * sample_seconds, count * sample_seconds, func_callers)
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
@@ -0,0 +1,53 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+class SlidingWindowLimiter:
+    """Per-key sliding-window rate limiter with a bounded number of tracked keys (least recently seen evicted)"""
+
+    def __init__(self, max_events, window_seconds, max_keys=10000):
+        self.logger = logging.getLogger(__name__)
+        self.max_events = max_events
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self.counters = OrderedDict()  # { key: [window_start, previous_count, current_count, suppressed] }
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """Count an event for key; returns False if it exceeds max_events in the sliding window"""
+        now = time.monotonic()
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = [now, 0, 0, 0]
+                self.counters[key] = counter
+                if len(self.counters) > self.max_keys:
+                    self.counters.popitem(last=False)
+            else:
+                self.counters.move_to_end(key)
+
+            elapsed = now - counter[0]
+            if elapsed >= 2 * self.window_seconds:
+                counter[0], counter[1], counter[2] = now, 0, 0
+                elapsed = 0
+            elif elapsed >= self.window_seconds:
+                counter[0], counter[1], counter[2] = counter[0] + self.window_seconds, counter[2], 0
+                elapsed -= self.window_seconds
+
+            # Weight the previous window by how much of it still overlaps the sliding window
+            estimate = counter[1] * (1 - elapsed / self.window_seconds) + counter[2]
+            if estimate >= self.max_events:
+                counter[3] += 1
+                return False
+            counter[2] += 1
+            return True
+
+    def pop_suppressed(self, key):
+        """Return and reset the number of events suppressed for key"""
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                return 0
+            suppressed, counter[3] = counter[3], 0
+            return suppressed
@@ -0,0 +1,118 @@
+import sqlite3
+import logging
+import time
+
+class SharedQueue:
+    """Outbound SMS queue in an SQLite file shared by several gateway instances. Each instance claims
+    messages under a time-limited lease; a message whose lease runs out (its node died or gave it back)
+    can be claimed by any node. Lease times use wall clock time, so node clocks must be in sync."""
+
+    def __init__(self, db_file, node_id, lease_seconds=300, max_claims=5):
+        self.logger = logging.getLogger(__name__)
+        self.db_file = db_file
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.max_claims = max_claims
+        self.init_database()
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def init_database(self):
+        self.logger.debug(f"Initializing shared queue {self.db_file}")
+        with self.connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS outbound
+                           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            destination TEXT,
+                            text TEXT,
+                            created_at REAL,
+                            status TEXT DEFAULT 'pending',
+                            claimed_by TEXT,
+                            lease_until REAL,
+                            claims INTEGER DEFAULT 0)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS outbound_status ON outbound (status, id)')
+        self.logger.info(f"Shared queue {self.db_file} initialized for node {self.node_id}")
+
+    def enqueue(self, destination, text):
+        with self.connect() as conn:
+            cursor = conn.execute('INSERT INTO outbound (destination, text, created_at) VALUES (?, ?, ?)',
+                                  (destination, text, time.time()))
+        return cursor.lastrowid
+
+    def enqueue_many(self, messages):
+        """Insert (destination, text) pairs in one transaction; returns how many were queued"""
+        now = time.time()
+        rows = [(destination, text, now) for destination, text in messages]
+        if rows:
+            with self.connect() as conn:
+                conn.executemany('INSERT INTO outbound (destination, text, created_at) VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def claim(self, limit):
+        """Lease up to limit unclaimed or expired messages to this node, oldest first"""
+        if limit <= 0:
+            return []
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, so two nodes can never select and lease the same rows
+        conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            failed = conn.execute('''UPDATE outbound SET status = 'failed'
+                                     WHERE status = 'pending' AND claims >= ? AND (lease_until IS NULL OR lease_until < ?)''',
+                                  (self.max_claims, now)).rowcount
+            rows = conn.execute('''SELECT id, destination, text FROM outbound
+                                   WHERE status = 'pending' AND (lease_until IS NULL OR lease_until < ?)
+                                   ORDER BY id LIMIT ?''', (now, limit)).fetchall()
+            if rows:
+                conn.execute(f"""UPDATE outbound SET claimed_by = ?, lease_until = ?, claims = claims + 1
+                                 WHERE id IN ({','.join('?' * len(rows))})""",
+                             [self.node_id, now + self.lease_seconds] + [row[0] for row in rows])
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        if failed:
+            self.logger.error(f"Gave up on {failed} shared message(s) after {self.max_claims} claims")
+        # No local retries: a failed message goes straight back to the queue, where max_claims bounds the attempts
+        return [{'destination': destination, 'text': text, 'retry_count': 0, 'max_retries': 0, 'shared_id': row_id}
+                for row_id, destination, text in rows]
+
+    def renew(self, ids):
+        """Extend the leases this node holds on ids"""
+        if not ids:
+            return
+        ids = list(ids)
+        with self.connect() as conn:
+            conn.execute(f"UPDATE outbound SET lease_until = ? WHERE claimed_by = ? AND id IN ({','.join('?' * len(ids))})",
+                         [time.time() + self.lease_seconds, self.node_id] + ids)
+
+    def complete(self, shared_id):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM outbound WHERE id = ? AND claimed_by = ?', (shared_id, self.node_id))
+
+    def release(self, ids, count_claim=True):
+        """Give leased messages back for any node to claim; without count_claim the claim is not held against them"""
+        if not ids:
+            return
+        ids = list(ids)
+        with self.connect() as conn:
+            conn.execute(f'''UPDATE outbound SET claimed_by = NULL, lease_until = NULL, claims = claims - ?
+                             WHERE claimed_by = ? AND status = 'pending' AND id IN ({','.join('?' * len(ids))})''',
+                         [0 if count_claim else 1, self.node_id] + ids)
+
+    def get_stats(self):
+        now = time.time()
+        with self.connect() as conn:
+            pending, leased, failed = conn.execute('''SELECT
+                    SUM(status = 'pending' AND (lease_until IS NULL OR lease_until < ?)),
+                    SUM(status = 'pending' AND lease_until >= ?),
+                    SUM(status = 'failed')
+                FROM outbound''', (now, now)).fetchone()
+            by_node = dict(conn.execute('''SELECT claimed_by, COUNT(*) FROM outbound
+                                           WHERE status = 'pending' AND lease_until >= ? GROUP BY claimed_by''',
+                                        (now,)).fetchall())
+        return {'node': self.node_id, 'pending': pending or 0, 'leased': leased or 0, 'failed': failed or 0,
+                'leased_by_node': by_node}
@@ -0,0 +1,59 @@
+import logging
+from collections import OrderedDict
+from gsmmodem.pdu import encodeSmsSubmitPdu
+
+class SmsEncoder:
+    """Encodes outbound text into SMS-SUBMIT PDUs; the text part is cached, so repeated texts to any destination skip it"""
+
+    def __init__(self, cache_size=256, request_status_report=True):
+        self.logger = logging.getLogger(__name__)
+        self.cache_size = cache_size
+        self.request_status_report = request_status_report
+        self.cache = OrderedDict()  # { text: [(first_octet, user_data_bytes, concat_ref_offset), ...] }
+
+    def encode(self, destination, text, reference):
+        """Return [(pdu_hex, tpdu_length), ...] for the message, stamped with the given reference"""
+        parts = self.cache.get(text)
+        if parts is None:
+            parts = self.build_parts(text)
+            if self.cache_size > 0:
+                self.cache[text] = parts
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(text)
+
+        address = self.encode_address(destination)
+        encoded = []
+        for first_octet, user_data, concat_ref_offset in parts:
+            # SMSC length (0, use the default SMSC), first octet, TP-MR, destination address, then PID onwards
+            pdu = bytearray((0x00, first_octet, reference)) + address + user_data
+            if concat_ref_offset is not None:
+                pdu[3 + len(address) + concat_ref_offset] = reference
+            encoded.append((pdu.hex().upper(), len(pdu) - 1))
+        return encoded
+
+    def build_parts(self, text):
+        """Classify (GSM-7 or UCS-2), split and encode the text, recording where the concatenation reference lives"""
+        pdus = encodeSmsSubmitPdu('0', text, reference=0, requestStatusReport=self.request_status_report)
+        parts = []
+        for pdu in pdus:
+            data = bytes(pdu.data)
+            user_data = data[3 + self.address_length(data):]
+            concat_ref_offset = None
+            # PID, DCS, UDL, UDHL, then the UDH
+            if len(pdus) > 1 and user_data[4] == 0x00 and user_data[5] == 0x03:
+                concat_ref_offset = 6
+            parts.append((data[1], user_data, concat_ref_offset))
+        self.logger.debug(f"Encoded message text into {len(parts)} PDU(s)")
+        return parts
+
+    def encode_address(self, destination):
+        """The TP-DA field for destination, taken from a one-character PDU"""
+        data = encodeSmsSubmitPdu(destination, ' ', reference=0, requestStatusReport=False)[0].data
+        return bytes(data[3:3 + self.address_length(data)])
+
+    @staticmethod
+    def address_length(data):
+        """Octets in the address field at data[3]: length in digits, type of address, then the packed digits"""
+        return 2 + (data[3] + 1) // 2
@@ -4,20 +4,31 @@ import time
 from datetime import datetime
 from collections import defaultdict
 from gsmmodem.pdu import Concatenation
+from dedup_cache import DedupCache
+from rate_limiter import SlidingWindowLimiter
 import re
 
+PHONE_NUMBER_RE = re.compile(r'^\+\d{6,15}$')
+EMAIL_RE = re.compile(r'^[^@]+@[^@]+\.[^@]+$')
+
 class SMSProcessor:
-    def __init__(self, memory_store, rules, multipart_timeout_minutes):
+    def __init__(self, memory_store, rules, multipart_timeout_minutes, dedup_ttl_seconds=0, dedup_max_entries=10000,
+                 rate_limits=None):
         self.logger = logging.getLogger(__name__)
         self.memory_store = memory_store
-        self.rules = rules
+        self.rate_limits = rate_limits or {}
+        self.sender_limiter = self.make_limiter(self.rate_limits.get('sender'))
+        self.rules = self.compile_rules(rules)
         self.modem_handlers = {}
         self.email_handlers = {}
         self.api_handlers = {}
+        self.delivery_tracker = None
+        self.shared_queue = None  # Set in scale-out mode: unpinned submissions go to the queue shared by all nodes
         self.multipart_store = defaultdict(list)  # { (sender, ref_num, modem_name): [(part_num, text, timestamp, total_parts), ...] }
         self.multipart_lock = threading.Lock()
         self.timeout_seconds = multipart_timeout_minutes * 60  # Convert minutes to seconds
         self.immediate_processing = self.timeout_seconds == 0  # Flag for immediate processing
+        self.dedup_cache = DedupCache(dedup_ttl_seconds, dedup_max_entries) if dedup_ttl_seconds > 0 else None
         if not self.immediate_processing:
             self.start_cleanup_thread()
         self.logger.debug(f"Initialized SMS processor with multipart timeout {multipart_timeout_minutes} minutes"
@@ -67,10 +78,54 @@ class SMSProcessor:
                     'multipart_part': received_parts
                 })()
                 
+                del self.multipart_store[key]
+                if self.is_duplicate(modem_name, sms):
+                    continue
                 self.memory_store.save_sms(modem_name, sms)
-                self.apply_rules(modem_name, sms)
+                if self.sender_allowed(modem_name, sms):
+                    self.apply_rules(modem_name, sms)
                 self.logger.info(f"Processed timed-out multipart message ref {ref_num} from {sender} on {modem_name}")
-                del self.multipart_store[key]
+
+    def make_limiter(self, limit):
+        """Build a limiter from {"max_messages": n, "window_seconds": s}, or None if unset or 0"""
+        if not limit or not limit.get('max_messages'):
+            return None
+        return SlidingWindowLimiter(limit['max_messages'], limit.get('window_seconds', 60),
+                                    max_keys=self.rate_limits.get('max_tracked', 10000))
+
+    def compile_rules(self, rules, previous=()):
+        """Precompute sender sets, lowercased content filters and rate limiters for each rule.
+        A rule of previous with the same name and limit settings hands its limiter over, keeping its windows"""
+        previous_by_name = {}
+        for compiled_rule in previous:
+            previous_by_name.setdefault(compiled_rule['name'], compiled_rule)
+        compiled = []
+        for rule in rules:
+            name = rule.get('name', 'unnamed_rule')
+            limit = rule.get('rate_limit', self.rate_limits.get('rule'))
+            limit_settings = (limit, self.rate_limits.get('max_tracked', 10000))
+            old = previous_by_name.pop(name, None)
+            if old is not None and old['limit_settings'] == limit_settings:
+                limiter = old['limiter']
+            else:
+                limiter = self.make_limiter(limit)
+            compiled.append({
+                'rule': rule,
+                'name': name,
+                'senders': frozenset(rule.get('sender', [])),
+                'contents': tuple(content.lower() for content in rule.get('content', [])),
+                'limiter': limiter,
+                'limit_settings': limit_settings
+            })
+        return compiled
+
+    def update_rules(self, rules, rate_limits=None):
+        """Swap in a new rule set; messages already being processed keep the old one"""
+        if rate_limits is not None and rate_limits != self.rate_limits:
+            self.rate_limits = rate_limits
+            self.sender_limiter = self.make_limiter(rate_limits.get('sender'))
+        self.rules = self.compile_rules(rules, self.rules)
+        self.logger.info(f"Updated rules: {[r['name'] for r in self.rules]}")
 
     def register_modem(self, port, handler):
         self.modem_handlers[handler.name] = handler
@@ -81,12 +136,45 @@ class SMSProcessor:
     def register_api(self, name, handler):
         self.api_handlers[name] = handler
 
+    def unregister_modem(self, name):
+        self.modem_handlers.pop(name, None)
+
+    def unregister_email(self, name):
+        self.email_handlers.pop(name, None)
+
+    def unregister_api(self, name):
+        self.api_handlers.pop(name, None)
+
     def process_sms(self, modem_name, sms):
         self.logger.debug(f"Handling SMS from {modem_name}, text: {sms.text}")
         complete_sms = self.handle_multipart(modem_name, sms)
-        if complete_sms:
+        if complete_sms and not self.is_duplicate(modem_name, complete_sms):
             self.memory_store.save_sms(modem_name, complete_sms)
-            self.apply_rules(modem_name, complete_sms)
+            if self.sender_allowed(modem_name, complete_sms):
+                self.apply_rules(modem_name, complete_sms)
+
+    def is_duplicate(self, modem_name, sms):
+        """Check a complete message against recently seen ones (same sender, text and SMSC timestamp)"""
+        if self.dedup_cache is None:
+            return False
+        if self.dedup_cache.check_and_add(sms):
+            self.logger.warning(f"Dropped duplicate SMS from {sms.number} on {modem_name}")
+            return True
+        return False
+
+    def sender_allowed(self, modem_name, sms):
+        """Apply the per-sender limit; suppressed messages are stored but not passed to the rules"""
+        if self.sender_limiter is None or self.sender_limiter.allow(sms.number):
+            return True
+        self.logger.warning(f"Rate limit exceeded for sender {sms.number} on {modem_name}, message suppressed")
+        return False
+
+    def get_suppressed_note(self, limiter, key, sender):
+        """Summarize messages dropped by a limiter since the last one that got through"""
+        suppressed = limiter.pop_suppressed(key) if limiter else 0
+        if not suppressed:
+            return ""
+        return f"\n[Note: {suppressed} earlier message(s) from {sender} suppressed by rate limit]"
 
     def handle_multipart(self, modem_name, sms):
         """Handle multipart SMS and return complete message if ready"""
@@ -156,84 +244,154 @@ class SMSProcessor:
     def validate_destination(self, queue_name, destination):
         if not destination:
             return False
-        modem_names = list(self.modem_handlers.keys())
-        email_names = list(self.email_handlers.keys())
-        if queue_name in modem_names:
-            if not re.match(r'^\+\d{6,15}$', destination):
+        if queue_name in self.modem_handlers:
+            if not PHONE_NUMBER_RE.match(destination):
                 self.logger.warning(f"Invalid phone number format for destination: {destination}")
                 return False
-        elif queue_name in email_names:
-            if not re.match(r'^[^@]+@[^@]+\.[^@]+$', destination):
+        elif queue_name in self.email_handlers:
+            if not EMAIL_RE.match(destination):
                 self.logger.warning(f"Invalid email format for destination: {destination}")
                 return False
         return True
 
+    def pick_modem(self, exclude=None, healthy_only=False):
+        """Return the name of the least loaded healthy modem, or of any modem if none is healthy (unless
+        healthy_only); queue length is weighted by delivery success so SIMs whose messages fail get less traffic"""
+        handlers = [h for h in self.modem_handlers.values() if h.name != exclude]
+        healthy = [h for h in handlers if h.healthy.is_set()]
+        candidates = healthy if healthy or healthy_only else handlers
+        if not candidates:
+            return None
+        if self.delivery_tracker is None:
+            return min(candidates, key=lambda h: h.outgoing_queue.qsize()).name
+        return min(candidates, key=lambda h: (h.outgoing_queue.qsize() + 1) / self.delivery_tracker.success_rate(h.name)).name
+
+    def reroute_sms(self, handler, message):
+        """Move an outgoing message from an unhealthy modem to a healthy one; False if none is available"""
+        target = self.pick_modem(exclude=handler.name, healthy_only=True)
+        if target is None:
+            return False
+        self.modem_handlers[target].outgoing_queue.put(message)
+        self.logger.info(f"Rerouted SMS to {message['destination']} from {handler.name} to {target}")
+        return True
+
+    def submit_sms(self, destination, text, modem_name=None, shared_batch=None):
+        """Validate and enqueue an outbound SMS; returns (modem_name, error), modem_name None if it went to the shared queue.
+        With shared_batch, shared-queue messages are appended to it for SharedQueue.enqueue_many instead"""
+        if not isinstance(text, str) or not text:
+            return None, "text must be a non-empty string"
+        if not isinstance(destination, str):
+            return None, "destination must be a string"
+        if modem_name is not None and not isinstance(modem_name, str):
+            return None, "modem must be a string"
+        if modem_name is None and self.shared_queue is not None:
+            if not PHONE_NUMBER_RE.match(destination):
+                return None, f"invalid destination {destination}"
+            if shared_batch is not None:
+                shared_batch.append((destination, text))
+            else:
+                self.shared_queue.enqueue(destination, text)
+            return None, None
+        if modem_name is None:
+            modem_name = self.pick_modem()
+            if modem_name is None:
+                return None, "no modem available"
+        handler = self.modem_handlers.get(modem_name)
+        if handler is None:
+            return None, f"unknown modem {modem_name}"
+        if not self.validate_destination(modem_name, destination):
+            return None, f"invalid destination {destination}"
+        handler.send_sms(destination, text)
+        return modem_name, None
+
     def apply_rules(self, modem_name, sms):
         self.logger.debug(f"Applying rules to SMS from {modem_name}")
-        for rule in self.rules:
-            rule_name = rule.get('name', 'unnamed_rule')
-            self.logger.debug(f"Checking rule: {rule_name}")
-            
-            senders = rule.get('sender', [])
-            if senders and sms.number not in senders:
-                continue
-            
-            contents = rule.get('content', [])
-            if contents and not any(content.lower() in sms.text.lower() for content in contents):
-                continue
-            
-            message = rule.get('message', [sms.text])[0]
-            if isinstance(message, list):
-                message = message[0]
-            
-            # Prepare message for API/SMTP
-            api_smtp_message = sms.text
-            
-            # Handle encap format for API/SMTP
-            if 'encap' in message.lower():
-                try:
-                    api_smtp_message = f"Sender: {sms.number}@{modem_name}\nTime: {sms.time.isoformat()}\nMessage:\n{api_smtp_message}"
-                except AttributeError as e:
-                    self.logger.error(f"Failed to format message for rule {rule_name}: {e}")
-                    api_smtp_message = f"Sender: {sms.number}@{modem_name}\nTime: Unknown\nMessage:\n{api_smtp_message}"
-            
-            # Add multipart note for API/SMTP if applicable
-            if hasattr(sms, 'multipart_ref'):
-                part_num = getattr(sms, 'multipart_part', None)
-                api_smtp_message += self.get_multipart_note(sms.number, sms.multipart_ref, part_num, sms.multipart_total)
+        for compiled_rule in self.rules:
+            self.apply_rule(modem_name, sms, compiled_rule)
+
+    def apply_rule(self, modem_name, sms, compiled_rule):
+        """Run one compiled rule against a message; returns True if it matched and was not rate limited"""
+        rule = compiled_rule['rule']
+        rule_name = compiled_rule['name']
+        self.logger.debug(f"Checking rule: {rule_name}")
+        
+        senders = compiled_rule['senders']
+        if senders and sms.number not in senders:
+            return False
+        
+        contents = compiled_rule['contents']
+        if contents:
+            text_lower = sms.text.lower()
+            if not any(content in text_lower for content in contents):
+                return False
+
+        limiter = compiled_rule['limiter']
+        if limiter is not None and not limiter.allow(sms.number):
+            self.logger.warning(f"Rule {rule_name}: Rate limit exceeded for {sms.number}, skipping actions")
+            return False
+        
+        message = rule.get('message', [sms.text])[0]
+        if isinstance(message, list):
+            message = message[0]
+        
+        # Prepare message for API/SMTP
+        api_smtp_message = sms.text
+        
+        # Handle encap format for API/SMTP
+        if 'encap' in message.lower():
+            try:
+                api_smtp_message = f"Sender: {sms.number}@{modem_name}\nTime: {sms.time.isoformat()}\nMessage:\n{api_smtp_message}"
+            except AttributeError as e:
+                self.logger.error(f"Failed to format message for rule {rule_name}: {e}")
+                api_smtp_message = f"Sender: {sms.number}@{modem_name}\nTime: Unknown\nMessage:\n{api_smtp_message}"
+        
+        # Add multipart note for API/SMTP if applicable
+        if hasattr(sms, 'multipart_ref'):
+            part_num = getattr(sms, 'multipart_part', None)
+            api_smtp_message += self.get_multipart_note(sms.number, sms.multipart_ref, part_num, sms.multipart_total)
+
+        # Report messages suppressed by the sender and rule limits since the last forward
+        api_smtp_message += self.get_suppressed_note(self.sender_limiter, sms.number, sms.number)
+        api_smtp_message += self.get_suppressed_note(limiter, sms.number, sms.number)
+        
+        action = rule.get('action', ['reply'])[0].lower()
+        queues = rule.get('queue', [modem_name])
+        destinations = rule.get('destination', [sms.number] if action == 'reply' else [])
+
+        if action == 'reply':
+            for queue_name in queues:
+                if queue_name in self.modem_handlers:
+                    self.modem_handlers[queue_name].send_sms(sms.number, sms.text)
+                    self.logger.info(f"Rule {rule_name}: Replied to {sms.number} from {queue_name} with message: {sms.text}")
+                else:
+                    self.logger.warning(f"Rule {rule_name}: Queue {queue_name} not found for reply")
+        elif action == 'forward':
+            if not queues:
+                self.logger.warning(f"Rule {rule_name}: No queues defined for forward action")
+                return True
             
-            action = rule.get('action', ['reply'])[0].lower()
-            queues = rule.get('queue', [modem_name])
-            destinations = rule.get('destination', [sms.number] if action == 'reply' else [])
-
-            if action == 'reply':
-                for queue_name in queues:
-                    if queue_name in self.modem_handlers:
-                        self.modem_handlers[queue_name].send_sms(sms.number, sms.text)
-                        self.logger.info(f"Rule {rule_name}: Replied to {sms.number} from {queue_name} with message: {sms.text}")
-                    else:
-                        self.logger.warning(f"Rule {rule_name}: Queue {queue_name} not found for reply")
-            elif action == 'forward':
-                if not queues:
-                    self.logger.warning(f"Rule {rule_name}: No queues defined for forward action")
-                    continue
-                
-                for queue_name in queues:
-                    if queue_name in self.api_handlers:
-                        self.api_handlers[queue_name].send_api(sms.number, sms.time.isoformat(), api_smtp_message)
-                        self.logger.info(f"Rule {rule_name}: Forwarded to API {queue_name} with message: {api_smtp_message}")
-                    elif queue_name in self.email_handlers:
-                        email_message = api_smtp_message if 'encap' in rule.get('message', [''])[0].lower() else api_smtp_message
-                        for dest in destinations:
-                            if self.validate_destination(queue_name, dest):
-                                self.email_handlers[queue_name].send_email(dest, email_message)
-                                self.logger.info(f"Rule {rule_name}: Forwarded to email {dest} via {queue_name}: {email_message}")
-                    elif queue_name in self.modem_handlers:
-                        for dest in destinations:
-                            if self.validate_destination(queue_name, dest):
-                                self.modem_handlers[queue_name].send_sms(dest, sms.text)
-                                self.logger.info(f"Rule {rule_name}: Forwarded to {dest} via {queue_name}: {sms.text}")
-                    else:
-                        self.logger.warning(f"Rule {rule_name}: Queue {queue_name} not found")
-            else:
-                self.logger.warning(f"Rule {rule_name}: Unknown action {action}, ignoring.")
\ No newline at end of file
+            for queue_name in queues:
+                if queue_name in self.api_handlers:
+                    self.api_handlers[queue_name].send_api(
+                        sms.number, sms.time.isoformat(), api_smtp_message, modem=modem_name,
+                        multipart_ref=getattr(sms, 'multipart_ref', ''),
+                        multipart_part=getattr(sms, 'multipart_part', '') or '',
+                        multipart_total=getattr(sms, 'multipart_total', '')
+                    )
+                    self.logger.info(f"Rule {rule_name}: Forwarded to API {queue_name} with message: {api_smtp_message}")
+                elif queue_name in self.email_handlers:
+                    email_message = api_smtp_message if 'encap' in rule.get('message', [''])[0].lower() else api_smtp_message
+                    for dest in destinations:
+                        if self.validate_destination(queue_name, dest):
+                            self.email_handlers[queue_name].send_email(dest, email_message)
+                            self.logger.info(f"Rule {rule_name}: Forwarded to email {dest} via {queue_name}: {email_message}")
+                elif queue_name in self.modem_handlers:
+                    for dest in destinations:
+                        if self.validate_destination(queue_name, dest):
+                            self.modem_handlers[queue_name].send_sms(dest, sms.text)
+                            self.logger.info(f"Rule {rule_name}: Forwarded to {dest} via {queue_name}: {sms.text}")
+                else:
+                    self.logger.warning(f"Rule {rule_name}: Queue {queue_name} not found")
+        else:
+            self.logger.warning(f"Rule {rule_name}: Unknown action {action}, ignoring.")
+        return True
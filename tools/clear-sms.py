@@ -1,207 +1,220 @@
-import serial
-import time
+import argparse
+import json
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import serial
+
+# GSM 03.38 default alphabet and extension table, indexed by septet value
+GSM7_BASIC = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED = {0x0A: '\f', 0x14: '^', 0x28: '{', 0x29: '}', 0x2F: '\\', 0x3C: '[', 0x3D: '~', 0x3E: ']', 0x40: '|', 0x65: '€'}
+
+FINAL_RESPONSES = ('OK', 'ERROR')
+ERROR_PREFIXES = ('+CMS ERROR', '+CME ERROR')
+
+print_lock = threading.Lock()
+
+def log(port, message):
+    with print_lock:
+        print(f"[{port}] {message}")
+
+def read_response(modem, timeout=10):
+    """Read lines until a final OK/ERROR result code or timeout; returns (ok, lines)"""
+    deadline = time.monotonic() + timeout
+    lines = []
+    while time.monotonic() < deadline:
+        raw = modem.readline()
+        if not raw:
+            continue
+        line = raw.decode('utf-8', errors='ignore').strip()
+        if not line:
+            continue
+        if line in FINAL_RESPONSES or line.startswith(ERROR_PREFIXES):
+            return line == 'OK', lines
+        lines.append(line)
+    return False, lines
+
+def send_command(modem, command, timeout=10):
+    modem.write(f'{command}\r'.encode())
+    return read_response(modem, timeout)
 
 def initialize_modem(port, baud_rate=9600):
-    """Initialize the GSM modem with PDU mode settings"""
+    """Open the port and set the GSM modem to PDU mode"""
     try:
-        modem = serial.Serial(
-            port=port,
-            baudrate=baud_rate,
-            timeout=1
-        )
-        print(f"Connected to {port} at {baud_rate} baud")
-
+        modem = serial.Serial(port=port, baudrate=baud_rate, timeout=0.1)
+        log(port, f"Connected at {baud_rate} baud")
         modem.reset_input_buffer()
         for _ in range(3):  # Retry up to 3 times
-            time.sleep(1)
-            modem.write(b'AT\r')
-            time.sleep(1)
-            response = modem.read(modem.in_waiting).decode('utf-8', errors='ignore')
-            if 'OK' in response:
+            if send_command(modem, 'AT', timeout=2)[0]:
                 break
         else:
             raise Exception("Modem not responding with OK after retries")
-
-        modem.write(b'AT+CMGF=0\r')  # Set to PDU mode
-        time.sleep(1)
-        response = modem.read(modem.in_waiting).decode('utf-8', errors='ignore')
-        if 'OK' not in response:
+        send_command(modem, 'ATE0', timeout=2)  # Echo off so responses only contain result lines
+        if not send_command(modem, 'AT+CMGF=0', timeout=2)[0]:
             raise Exception("Failed to set PDU mode")
-
-        print("Modem initialized successfully in PDU mode")
+        log(port, "Modem initialized successfully in PDU mode")
         return modem
-    
     except Exception as e:
-        print(f"Error initializing modem: {e}")
+        log(port, f"Error initializing modem: {e}")
         return None
 
-def read_full_response(modem, timeout=10):
-    """Read all data until OK or timeout"""
-    start_time = time.time()
-    full_response = ""
-    last_data_time = start_time
-    while time.time() - start_time < timeout:
-        if modem.in_waiting > 0:
-            chunk = modem.read(modem.in_waiting).decode('utf-8', errors='ignore')
-            full_response += chunk
-            last_data_time = time.time()
-        if 'OK' in full_response or 'ERROR' in full_response:
-            break
-        if time.time() - last_data_time > 5:
-            break
-        time.sleep(0.2)
-    return full_response
-
-def decode_gsm7(hex_data, num_chars):
-    """Decode GSM 7-bit packed data into text"""
-    bytes_data = bytes.fromhex(hex_data)
-    bits = []
-    for byte in bytes_data:
-        byte_bits = bin(byte)[2:].zfill(8)
-        bits.extend(byte_bits)
-    septets = []
-    for i in range(num_chars):
-        start = i * 7
-        if start + 7 <= len(bits):
-            septet_bits = bits[start:start+7]
-            septet = int(''.join(septet_bits), 2)
-            char = chr(septet) if 32 <= septet <= 126 else '?'
-            septets.append(char)
-    return ''.join(septets)
-
-def get_sender(pdu):
-    """Extract sender number from PDU"""
-    sender_len = int(pdu[18:20], 16)  # Length of sender number in digits
-    sender_hex = pdu[20:20 + sender_len + 2]  # Include type of number
-    if sender_hex.startswith('91'):  # International format
-        sender = '+' + ''.join([sender_hex[i+2:i+4] for i in range(0, sender_len, 2)])
-        # Swap pairs for correct order
-        sender = '+' + ''.join(sender[i+1] + sender[i] for i in range(1, len(sender)-1, 2))
+def decode_gsm7(data, num_septets, skip_bits=0):
+    """Unpack GSM 7-bit packed bytes into text using the default alphabet tables"""
+    packed = int.from_bytes(data, 'little')
+    chars = []
+    escape = False
+    for i in range(num_septets):
+        septet = (packed >> (skip_bits + i * 7)) & 0x7F
+        if escape:
+            chars.append(GSM7_EXTENDED.get(septet, '?'))
+            escape = False
+        elif septet == 0x1B:
+            escape = True
+        else:
+            chars.append(GSM7_BASIC[septet])
+    return ''.join(chars)
+
+def decode_address(data, num_digits, type_of_address):
+    """Decode a semi-octet (or alphanumeric) address field"""
+    if type_of_address & 0x70 == 0x50:  # Alphanumeric
+        return decode_gsm7(data, num_digits * 4 // 7)
+    digits = ''.join(f"{byte & 0x0F:X}{byte >> 4:X}" for byte in data)[:num_digits]
+    return ('+' if type_of_address & 0x70 == 0x10 else '') + digits
+
+def decode_timestamp(data):
+    swapped = ''.join(f"{byte & 0x0F}{byte >> 4}" for byte in data)
+    century = '19' if swapped[0:2] >= '90' else '20'
+    return f"{century}{swapped[0:2]}-{swapped[2:4]}-{swapped[4:6]}T{swapped[6:8]}:{swapped[8:10]}:{swapped[10:12]}"
+
+def decode_pdu(pdu_hex):
+    """Decode an SMS-DELIVER PDU into (sender, timestamp, text); status reports and others get a type only"""
+    pdu = bytes.fromhex(pdu_hex)
+    pos = pdu[0] + 1  # Skip SMSC information
+    first_octet = pdu[pos]
+    if first_octet & 0x03 != 0x00:
+        return {'type': 'status-report' if first_octet & 0x03 == 0x02 else 'other'}
+    num_digits = pdu[pos + 1]
+    address_bytes = (num_digits + 1) // 2
+    sender = decode_address(pdu[pos + 3:pos + 3 + address_bytes], num_digits, pdu[pos + 2])
+    pos += 3 + address_bytes
+    dcs = pdu[pos + 1]
+    timestamp = decode_timestamp(pdu[pos + 2:pos + 9])
+    udl = pdu[pos + 9]
+    user_data = pdu[pos + 10:]
+    header_bytes = 0
+    if first_octet & 0x40:  # User data header present
+        header_bytes = user_data[0] + 1
+    if dcs & 0xC0 == 0x00:  # General data coding
+        alphabet = dcs & 0x0C
+    elif dcs & 0xF0 == 0xE0:  # Message waiting, UCS-2
+        alphabet = 0x08
+    elif dcs & 0xF0 == 0xF0:  # Data coding/message class
+        alphabet = dcs & 0x04
     else:
-        sender = sender_hex[2:]  # Fallback, may need adjustment
-    return sender
-
-def read_all_messages(modem, storage):
-    """Read and display all messages from specified storage (ME or SM)"""
-    try:
-        # Set storage location
-        modem.write(f'AT+CPMS="{storage}"\r'.encode())
-        time.sleep(1)
-        response = read_full_response(modem)
-        if 'OK' not in response:
-            print(f"Failed to set storage to {storage}: {response}")
-            return []
-
-        # List all messages
-        modem.write(b'AT+CMGL=4\r')  # 4 = all messages in PDU mode
-        time.sleep(1)
-        response = read_full_response(modem)
-        if 'OK' not in response:
-            print(f"Failed to list messages from {storage}: {response}")
-            return []
-
-        messages = []
-        lines = response.split('\n')
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if '+CMGL:' in line and i + 1 < len(lines):
-                index = line.split(',')[0].split(':')[1].strip()
-                pdu = lines[i + 1].strip()
-                udl = int(pdu[20:22], 16)
-                ud_start = 22 + int(pdu[18:20], 16) * 2
-                ud_data = pdu[ud_start:]
-                sender = get_sender(pdu)
-                message = decode_gsm7(ud_data, udl)
-                
-                messages.append((index, sender, message))
-                print(f"\nStorage: {storage}, Index: {index}")
-                print(f"Sender: {sender}")
-                print(f"Message: {message}")
-                i += 2
-            else:
-                i += 1
-        return messages
-    
-    except Exception as e:
-        print(f"Error reading messages from {storage}: {e}")
-        return []
+        alphabet = 0x00
+    if alphabet == 0x08:  # UCS-2
+        text = user_data[header_bytes:udl].decode('utf-16-be', errors='replace')
+    elif alphabet == 0x04:  # 8-bit data
+        text = user_data[header_bytes:udl].hex()
+    else:
+        header_septets = (header_bytes * 8 + 6) // 7
+        text = decode_gsm7(user_data, udl - header_septets, skip_bits=header_septets * 7)
+    return {'type': 'deliver', 'sender': sender, 'timestamp': timestamp, 'text': text}
+
+def read_all_messages(port, modem, storage):
+    """List all messages in the given storage (ME or SM) with a single AT+CMGL"""
+    if not send_command(modem, f'AT+CPMS="{storage}"')[0]:
+        log(port, f"Failed to set storage to {storage}")
+        return None
+    ok, lines = send_command(modem, 'AT+CMGL=4', timeout=60)  # 4 = all messages in PDU mode
+    if not ok:
+        log(port, f"Failed to list messages from {storage}")
+        return None
 
-def delete_all_messages(modem, storage, indices):
-    """Delete all messages from specified storage using individual indices"""
+    messages = []
+    for header, pdu_hex in zip(lines, lines[1:]):
+        if not header.startswith('+CMGL:'):
+            continue
+        fields = header[6:].split(',')
+        message = {'port': port, 'storage': storage, 'index': int(fields[0]), 'status': int(fields[1]), 'pdu': pdu_hex}
+        try:
+            message.update(decode_pdu(pdu_hex))
+        except (ValueError, IndexError) as e:
+            message['error'] = f"undecodable PDU: {e}"
+        messages.append(message)
+    log(port, f"Found {len(messages)} message(s) in {storage}")
+    return messages
+
+def delete_all_messages(port, modem, storage, messages):
+    """Delete listed messages with one AT+CMGD, falling back to per-index deletes"""
+    if not send_command(modem, f'AT+CPMS="{storage}"')[0]:
+        log(port, f"Failed to set storage to {storage} for deletion")
+        return False
+    # Flag 3 removes read, sent and unsent messages; listing marked everything read, so only unread arrivals since stay
+    if send_command(modem, 'AT+CMGD=1,3', timeout=60)[0]:
+        log(port, f"All listed messages deleted from {storage}")
+        return True
+    log(port, f"Bulk delete not supported in {storage}, deleting {len(messages)} message(s) individually")
+    success = True
+    for message in messages:
+        if not send_command(modem, f"AT+CMGD={message['index']}")[0]:
+            log(port, f"Failed to delete message at index {message['index']} in {storage}")
+            success = False
+    return success
+
+def process_port(port, args, export_file, export_lock):
+    modem = initialize_modem(port, args.baud)
+    if not modem:
+        return False
     try:
-        # Set storage location
-        modem.write(f'AT+CPMS="{storage}"\r'.encode())
-        time.sleep(1)
-        response = read_full_response(modem)
-        if 'OK' not in response:
-            print(f"Failed to set storage to {storage} for deletion: {response}")
-            return False
-
-        success = True
-        for index in indices:
-            modem.write(f'AT+CMGD={index}\r'.encode())
-            time.sleep(1)
-            response = read_full_response(modem)
-            if 'OK' not in response:
-                print(f"Failed to delete message at index {index} in {storage}: {response}")
-                success = False
-            else:
-                print(f"Deleted message at index {index} in {storage}")
-        if success:
-            print(f"All messages deleted from {storage}")
-        return success
-    
+        for storage in args.storage:
+            messages = read_all_messages(port, modem, storage)
+            if messages is None:
+                continue
+            if args.verbose:
+                for message in messages:
+                    log(port, f"{storage} #{message['index']} {message.get('sender', '')}: {message.get('text', message.get('type'))}")
+            if export_file and messages:
+                data = ''.join(json.dumps(message, ensure_ascii=False) + '\n' for message in messages)
+                with export_lock:
+                    export_file.write(data)
+                    export_file.flush()
+            if not args.no_delete and messages:
+                delete_all_messages(port, modem, storage, messages)
+        return True
     except Exception as e:
-        print(f"Error deleting messages from {storage}: {e}")
+        log(port, f"Error: {e}")
         return False
+    finally:
+        modem.close()
+        log(port, "Modem connection closed")
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python3 sms_reader_deleter.py <port>")
-        print("Example: python3 sms_reader_deleter.py /dev/ttyUSB0")
-        sys.exit(1)
-
-    PORT = sys.argv[1]
-    BAUD_RATE = 19200
-
-    print("Starting SMS reader and deleter...")
-    print(f"Using port: {PORT}")
-
-    modem = initialize_modem(PORT, BAUD_RATE)
-    if not modem:
-        print("Modem initialization failed. Exiting.")
-        sys.exit(1)
-
+    parser = argparse.ArgumentParser(description="Read, export and clear SMS stored on one or more GSM modems")
+    parser.add_argument('ports', nargs='+', help="Serial ports, e.g. /dev/ttyUSB0 /dev/ttyUSB2")
+    parser.add_argument('--baud', type=int, default=19200, help="Baud rate (default: 19200)")
+    parser.add_argument('--storage', nargs='+', default=['ME', 'SM'], help="Storages to clear (default: ME SM)")
+    parser.add_argument('--export', metavar='FILE', help="Append messages as NDJSON to FILE before clearing")
+    parser.add_argument('--no-delete', action='store_true', help="Only read (and export) messages")
+    parser.add_argument('--workers', type=int, default=16, help="Ports processed concurrently (default: 16)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print every message")
+    args = parser.parse_args()
+
+    export_file = open(args.export, 'a', encoding='utf-8') if args.export else None
+    export_lock = threading.Lock()
     try:
-        # Read and display messages from ME (modem memory)
-        print("\nReading messages from ME (modem memory):")
-        me_messages = read_all_messages(modem, "ME")
-        me_indices = [msg[0] for msg in me_messages]
-
-        # Read and display messages from SM (SIM card)
-        print("\nReading messages from SM (SIM card):")
-        sm_messages = read_all_messages(modem, "SM")
-        sm_indices = [msg[0] for msg in sm_messages]
-
-        # Delete all messages from ME
-        print("\nDeleting all messages from ME...")
-        delete_all_messages(modem, "ME", me_indices)
-
-        # Delete all messages from SM
-        print("\nDeleting all messages from SM...")
-        delete_all_messages(modem, "SM", sm_indices)
-
-        print("\nOperation completed.")
-
-    except Exception as e:
-        print(f"Error in main process: {e}")
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(lambda port: process_port(port, args, export_file, export_lock), args.ports))
     finally:
-        modem.close()
-        print("Modem connection closed.")
+        if export_file:
+            export_file.close()
+
+    print(f"\nOperation completed: {sum(results)}/{len(results)} port(s) processed successfully.")
+    sys.exit(0 if all(results) else 1)
 
 if __name__ == "__main__":
     main()
-
-
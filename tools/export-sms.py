@@ -0,0 +1,54 @@
+import argparse
+import io
+import os
+import shutil
+import sys
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from export import parse_time, export_records  # noqa: E402
+
+def export_from_database(args, output):
+    from database import DatabaseManager
+    records = DatabaseManager(args.db).iter_sms(
+        since=parse_time(args.since),
+        until=parse_time(args.until),
+        sender=args.sender
+    )
+    for chunk in export_records(records, args.format):
+        output.write(chunk)
+
+def export_from_gateway(args, output):
+    query = {k: v for k, v in {'format': args.format, 'since': args.since, 'until': args.until, 'sender': args.sender}.items() if v}
+    request = urllib.request.Request(f"{args.url.rstrip('/')}/export?{urllib.parse.urlencode(query)}")
+    if args.token:
+        request.add_header('Authorization', f"Bearer {args.token}")
+    with urllib.request.urlopen(request) as response:
+        shutil.copyfileobj(io.TextIOWrapper(response, encoding='utf-8', newline=''), output, 64 * 1024)
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream stored SMS messages as NDJSON or CSV")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--db', metavar='FILE', help="Read from an SQLite message database")
+    source.add_argument('--url', help="Read the in-memory store of a running gateway, e.g. http://127.0.0.1:8025")
+    parser.add_argument('--token', help="Admin server token (with --url)")
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--since', help="Only messages at or after this time (epoch seconds or ISO 8601)")
+    parser.add_argument('--until', help="Only messages at or before this time (epoch seconds or ISO 8601)")
+    parser.add_argument('--sender', help="Only messages from this number")
+    parser.add_argument('-o', '--output', help="Output file (default: stdout)")
+    args = parser.parse_args()
+
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        if args.db:
+            export_from_database(args, output)
+        else:
+            export_from_gateway(args, output)
+    finally:
+        if args.output:
+            output.close()
+
+if __name__ == "__main__":
+    main()
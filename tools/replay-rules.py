@@ -0,0 +1,162 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gsmmodem.pdu import Concatenation  # noqa: E402
+from export import parse_time  # noqa: E402
+from sms_processor import SMSProcessor  # noqa: E402
+
+class Recorder:
+    """Stands in for a modem, email or API handler and counts what would have been queued"""
+
+    def __init__(self, name, fanout):
+        self.name = name
+        self.fanout = fanout
+
+    def send_sms(self, destination, text):
+        self.fanout[self.name] += 1
+
+    def send_email(self, destination, text):
+        self.fanout[self.name] += 1
+
+    def send_api(self, sender, timestamp, text, **fields):
+        self.fanout[self.name] += 1
+
+def make_sms(record):
+    """Build an SMS object from an export record (modem, sender, timestamp, text, optional multipart_*)"""
+    attributes = {
+        'number': record.get('sender') or record.get('number', ''),
+        'time': parse_time(record.get('timestamp') or record.get('time')) or datetime.now(),
+        'text': record.get('text', '')
+    }
+    if record.get('multipart_ref') not in (None, ''):
+        reference = int(record['multipart_ref'])
+        data = [int(record['multipart_total']), int(record['multipart_part'])]
+        if reference > 0xFF:
+            attributes['udh'] = [Concatenation(0x08, 4, [reference >> 8, reference & 0xFF] + data)]
+        else:
+            attributes['udh'] = [Concatenation(0x00, 3, [reference] + data)]
+    return type('SMS', (), attributes)()
+
+def replay(processor, lines, default_modem, fanout):
+    """Run each record through multipart reassembly, dedup, the sender limit and every rule, timing each rule"""
+    rule_matches = Counter()
+    rule_seconds = defaultdict(float)
+    counts = Counter()
+    started = time.perf_counter()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        counts['messages'] += 1
+        modem_name = record.get('modem') or default_modem
+        complete_sms = processor.handle_multipart(modem_name, make_sms(record))
+        if complete_sms is None:
+            counts['pending_parts'] += 1
+            continue
+        if processor.is_duplicate(modem_name, complete_sms):
+            counts['duplicates'] += 1
+            continue
+        if not processor.sender_allowed(modem_name, complete_sms):
+            counts['sender_limited'] += 1
+            continue
+        counts['evaluated'] += 1
+        for compiled_rule in processor.rules:
+            rule_started = time.perf_counter()
+            matched = processor.apply_rule(modem_name, complete_sms, compiled_rule)
+            rule_seconds[compiled_rule['name']] += time.perf_counter() - rule_started
+            if matched:
+                rule_matches[compiled_rule['name']] += 1
+    elapsed = time.perf_counter() - started
+
+    return {
+        'messages': counts['messages'],
+        'evaluated': counts['evaluated'],
+        'pending_parts': counts['pending_parts'],
+        'incomplete_multipart': len(processor.multipart_store),
+        'duplicates': counts['duplicates'],
+        'sender_limited': counts['sender_limited'],
+        'elapsed_seconds': elapsed,
+        'messages_per_second': counts['messages'] / elapsed if elapsed else None,
+        'rules': [
+            {
+                'name': compiled_rule['name'],
+                'matches': rule_matches[compiled_rule['name']],
+                'total_ms': rule_seconds[compiled_rule['name']] * 1000,
+                'mean_us': rule_seconds[compiled_rule['name']] * 1e6 / counts['evaluated'] if counts['evaluated'] else None
+            }
+            for compiled_rule in processor.rules
+        ],
+        'fanout': dict(fanout)
+    }
+
+def print_report(report, output):
+    output.write(f"Messages: {report['messages']} ({report['evaluated']} evaluated, {report['pending_parts']} multipart parts held, "
+                 f"{report['incomplete_multipart']} incomplete at end, {report['duplicates']} duplicates, "
+                 f"{report['sender_limited']} sender rate limited)\n")
+    rate = report['messages_per_second']
+    output.write(f"Elapsed: {report['elapsed_seconds']:.3f}s ({rate:.0f} msgs/sec)\n\n" if rate else "Elapsed: 0s\n\n")
+    output.write(f"{'Rule':<30} {'Matches':>10} {'Total ms':>12} {'Mean us':>10}\n")
+    for rule in report['rules']:
+        mean = f"{rule['mean_us']:.1f}" if rule['mean_us'] is not None else '-'
+        output.write(f"{rule['name']:<30} {rule['matches']:>10} {rule['total_ms']:>12.2f} {mean:>10}\n")
+    output.write(f"\n{'Queue':<30} {'Enqueued':>10}\n")
+    for queue_name, count in sorted(report['fanout'].items(), key=lambda item: -item[1]):
+        output.write(f"{queue_name:<30} {count:>10}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured inbound messages through the rules without sending anything")
+    parser.add_argument('input', help="NDJSON file of messages as written by export-sms.py ('-' for stdin)")
+    parser.add_argument('--config', default='config.json', help="Gateway config file with the rules to test")
+    parser.add_argument('--modem', help="Modem name for records without one (default: first configured modem)")
+    parser.add_argument('--no-rate-limits', action='store_true',
+                        help="Ignore rate_limits; replay runs far faster than real traffic and would trip them")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Log every rule decision")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    with open(args.config) as f:
+        config = json.load(f)
+    processor = SMSProcessor(
+        None,
+        config.get('rules', []),
+        0,  # No cleanup thread: parts left unpaired are reported instead of timing out mid-replay
+        dedup_ttl_seconds=config.get('dedup_ttl_seconds', 3600),
+        dedup_max_entries=config.get('dedup_max_entries', 10000),
+        rate_limits=None if args.no_rate_limits else config.get('rate_limits', {})
+    )
+    processor.immediate_processing = config.get('multipart_timeout_minutes', 5) == 0
+    fanout = Counter()
+    for conf in config.get('modems', []):
+        processor.register_modem(conf.get('port'), Recorder(conf.get('name', 'UnnamedModem'), fanout))
+    for conf in config.get('email_providers', []):
+        processor.register_email(conf['name'], Recorder(conf['name'], fanout))
+    for conf in config.get('api_providers', []):
+        processor.register_api(conf['name'], Recorder(conf['name'], fanout))
+    default_modem = args.modem or next(iter(processor.modem_handlers), 'replay')
+
+    lines = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    try:
+        report = replay(processor, lines, default_modem, fanout)
+    finally:
+        if args.input != '-':
+            lines.close()
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print_report(report, sys.stdout)
+
+if __name__ == "__main__":
+    main()